@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Benchmark how ``mqtop`` loads one user's jobs from a ``qstat.json`` snapshot.
+
+Writes a synthetic cluster snapshot in which one user has ``--jobs`` jobs,
+then times each way ``mqtop`` can read them: ``qstat_filter --compact``,
+``qstat_filter`` printing raw JSON jobs for ``_parse_job``, the streaming
+pure Python fallback and a plain ``json.load`` of the whole file. The
+``qstat_filter`` rows need a release build of it.
+
+    python3 benchmarks/bench_mqtop_load.py --jobs 1000
+"""
+
+import argparse
+import json
+import os
+import runpy
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO))
+
+from hpc_scripts.synthetic_qstat import synthetic_snapshot  # noqa: E402
+
+QSTAT_FILTER = REPO / "qstat_filter" / "target" / "release" / "qstat_filter"
+
+
+def timed(fn, repeat):
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=1000, help="Jobs of the loading user [default: 1000]")
+    parser.add_argument("--other-jobs", type=int, default=50000, help="Jobs of other users [default: 50000]")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each method; the median is shown [default: 5]")
+    args = parser.parse_args()
+
+    mqtop = runpy.run_path(str(REPO / "bin" / "mqtop"))
+    ArrayJobCollector = mqtop["ArrayJobCollector"]
+
+    def compact(path):
+        proc = subprocess.run([str(QSTAT_FILTER), "--compact", path, "me"], text=True, capture_output=True, check=True)
+        collector = ArrayJobCollector()
+        for line in proc.stdout.split("\n")[1:]:
+            if line:
+                mqtop["_collect_parsed_job"](collector, mqtop["_parse_compact_row"](line))
+        return collector.jobs
+
+    def ndjson(path):
+        proc = subprocess.run([str(QSTAT_FILTER), path, "me"], text=True, capture_output=True, check=True)
+        collector = ArrayJobCollector()
+        for line in proc.stdout.splitlines():
+            mqtop["_collect_job"](collector, json.loads(line))
+        return collector.jobs
+
+    def streaming(path):
+        collector = ArrayJobCollector()
+        with open(path) as fh:
+            for jid, info in mqtop["iter_jobs"](fh, euser="me"):
+                info["id"] = jid
+                mqtop["_collect_job"](collector, info)
+        return collector.jobs
+
+    def json_load(path):
+        with open(path) as fh:
+            data = json.load(fh)
+        collector = ArrayJobCollector()
+        for jid, info in data["Jobs"].items():
+            if info.get("euser") == "me":
+                mqtop["_collect_job"](collector, dict(info, id=jid))
+        return collector.jobs
+
+    methods = [("python streaming", streaming), ("python json.load", json_load)]
+    if QSTAT_FILTER.exists():
+        methods = [("qstat_filter --compact", compact), ("qstat_filter json", ndjson)] + methods
+    else:
+        print(f"{QSTAT_FILTER} not built; only timing the Python fallback")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "qstat.json")
+        with open(path, "w") as fh:
+            json.dump(synthetic_snapshot(args.jobs, args.other_jobs), fh)
+        size_mb = os.path.getsize(path) / 1024 / 1024
+        print(f"snapshot {size_mb:.1f} MB, {args.jobs} jobs of the loading user, {args.other_jobs} of others")
+        for label, fn in methods:
+            seconds, jobs = timed(lambda: fn(path), args.repeat)
+            tracemalloc.start()
+            fn(path)
+            peak_mb = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            tracemalloc.stop()
+            print(f"{label:<24} {seconds * 1000:8.1f} ms  {peak_mb:7.1f} MB peak  ({len(jobs)} jobs)")
+        # The Python side of each qstat_filter mode, given its output.
+        if QSTAT_FILTER.exists():
+            compact_out = subprocess.run([str(QSTAT_FILTER), "--compact", path, "me"], text=True,
+                                         capture_output=True, check=True).stdout.split("\n")[1:]
+            json_out = subprocess.run([str(QSTAT_FILTER), path, "me"], text=True,
+                                      capture_output=True, check=True).stdout.splitlines()
+            seconds, _ = timed(lambda: [mqtop["_parse_compact_row"](line) for line in compact_out if line], args.repeat)
+            print(f"{'  parse compact rows':<24} {seconds * 1000:8.1f} ms")
+            seconds, _ = timed(lambda: [mqtop["_parse_job"](json.loads(line)) for line in json_out], args.repeat)
+            print(f"{'  parse json + _parse_job':<24} {seconds * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""Benchmark ``mqstat``'s ``qstat -f`` parser on a synthetic dump.
+
+Compares the table-driven streaming parser (``parse_qstat``) with the
+previous regex-per-line implementation, which is kept below as
+``legacy_parse`` for reference.
+
+    python3 benchmarks/bench_parse_qstat.py --jobs 100000
+"""
+
+import argparse
+import os
+import random
+import re
+import runpy
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parents[1]
+
+QUEUES = ["cpu_batch_exec", "gpu_batch_exec", "microbiome", "cpu_inter_exec"]
+STATES = ["R", "Q", "H", "F"]
+DAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+def _pbs_time(ts):
+    dt = datetime.fromtimestamp(ts)
+    return f"{DAYS[dt.weekday()]} {MONTHS[dt.month - 1]} {dt.day:2d} {dt:%H:%M:%S} {dt.year}"
+
+
+def _hms(seconds):
+    return f"{seconds // 3600:02}:{(seconds % 3600) // 60:02}:{seconds % 60:02}"
+
+
+def synthetic_qstat_f(fh, num_jobs, seed=0):
+    """Write *num_jobs* jobs in ``qstat -xf -t`` format to *fh*."""
+    rng = random.Random(seed)
+    base = int(time.time()) - 7 * 24 * 3600
+    for i in range(num_jobs):
+        state = rng.choice(STATES)
+        ncpus = rng.choice([1, 2, 4, 8, 16, 24, 32, 64])
+        walltime = rng.choice([1, 4, 12, 24, 48]) * 3600
+        used = rng.randrange(walltime)
+        qtime = base + rng.randrange(7 * 24 * 3600)
+        stime = qtime + rng.randrange(3600)
+        user = f"user{rng.randrange(200)}"
+        fh.write(f"Job Id: {10000000 + i}.aqua\n")
+        fh.write(f"    Job_Name = job{i}.sh\n")
+        fh.write(f"    Job_Owner = {user}@aquarius01.ib0.hpc.qut.edu.au\n")
+        if state in ("R", "F"):
+            fh.write(f"    resources_used.cpupercent = {rng.randrange(ncpus * 100)}\n")
+            fh.write(f"    resources_used.cput = {_hms(used * ncpus // 2)}\n")
+            fh.write(f"    resources_used.mem = {rng.randrange(1, 10**8)}kb\n")
+            fh.write(f"    resources_used.ncpus = {ncpus}\n")
+            fh.write(f"    resources_used.vmem = {rng.randrange(1, 10**8)}kb\n")
+            fh.write(f"    resources_used.walltime = {_hms(used)}\n")
+        fh.write(f"    job_state = {state}\n")
+        fh.write(f"    queue = {rng.choice(QUEUES)}\n")
+        fh.write("    server = aqua\n")
+        fh.write(f"    ctime = {_pbs_time(qtime)}\n")
+        fh.write(f"    Error_Path = aquarius01:/home/{user}/job{i}.sh.e{i}\n")
+        fh.write(f"    mtime = {_pbs_time(stime + used)}\n")
+        fh.write(f"    Output_Path = aquarius01:/home/{user}/job{i}.sh.o{i}\n")
+        fh.write(f"    qtime = {_pbs_time(qtime)}\n")
+        fh.write(f"    Resource_List.mem = {ncpus * 8}gb\n")
+        fh.write(f"    Resource_List.ncpus = {ncpus}\n")
+        fh.write("    Resource_List.ngpus = 0\n")
+        fh.write(f"    Resource_List.select = 1:mem={ncpus * 8}gb:ncpus={ncpus}:ngpus=0\n")
+        fh.write(f"    Resource_List.walltime = {_hms(walltime)}\n")
+        if state in ("R", "F"):
+            fh.write(f"    stime = {_pbs_time(stime)}\n")
+        if state == "F":
+            fh.write(f"    obittime = {_pbs_time(stime + used)}\n")
+            fh.write(f"    Exit_status = {rng.choice([0, 0, 0, 1])}\n")
+        fh.write(f"    Variable_List = PBS_O_HOME=/home/{user},PBS_O_LOGNAME={user},\n")
+        fh.write(f"\tPBS_O_WORKDIR=/work/microbiome/{user}/run{i},PBS_O_QUEUE=cpu_batch\n")
+        fh.write("\n")
+
+
+def legacy_parse(output):
+    """The regex-per-line ``qstat -f`` parser mqstat used previously."""
+    jobs = []
+    current_job = None
+    for line in output.splitlines():
+        job_match = re.match(r'^Job Id: (.+)$', line)
+        if job_match:
+            if current_job:
+                jobs.append(current_job)
+            current_job = {'id': job_match.group(1), 'user': None, 'ncpus': 0,
+                           'cpu_usage': 0, 'mem_usage': 0, 'gpu_usage': 0,
+                           'state': None}
+            continue
+        if not current_job:
+            continue
+
+        name_match = re.search(r'Job_Name = (.+)', line)
+        if name_match:
+            current_job['name'] = name_match.group(1)
+        queue_match = re.search(r'queue = (.+)', line)
+        if queue_match:
+            current_job['queue'] = queue_match.group(1)
+        owner_match = re.search(r'Job_Owner = (.+)@', line)
+        if owner_match:
+            current_job['user'] = owner_match.group(1)
+        state_match = re.search(r'job_state = ([A-Z])', line)
+        if state_match:
+            current_job['state'] = state_match.group(1)
+        for attr, field in (('qtime', 'qtime'), ('stime', 'start_time'),
+                            ('obittime', 'obittime'), ('mtime', 'mtime')):
+            time_match = re.search(attr + r' = (.+)', line)
+            if time_match:
+                try:
+                    dt = datetime.strptime(time_match.group(1).strip(), "%a %b %d %H:%M:%S %Y")
+                    current_job[field] = int(dt.timestamp())
+                except ValueError:
+                    pass
+
+        if 'resources_used' in line or 'Resource_List' in line:
+            cpu_match = re.search(r'Resource_List.ncpus = (\d+)', line)
+            if cpu_match:
+                current_job['ncpus'] = int(cpu_match.group(1))
+            cpu_match = re.search(r'resources_used.cpupercent = (\d+)', line)
+            if cpu_match:
+                current_job['cpupercent'] = int(cpu_match.group(1))
+            ncpus_used_match = re.search(r'resources_used.ncpus = (\d+)', line)
+            if ncpus_used_match:
+                current_job['ncpus_used'] = int(ncpus_used_match.group(1))
+            if 'resources_used.mem' in line:
+                mem_match1 = re.search(r'resources_used.mem = (\d+)kb', line)
+                mem_match2 = re.search(r'resources_used.mem = (\d+)gb', line)
+                mem_match3 = re.search(r'resources_used.mem = 0b', line)
+                if mem_match1:
+                    current_job['mem_usage'] = int(mem_match1.group(1))
+                elif mem_match2:
+                    current_job['mem_usage'] = int(mem_match2.group(1)) * 1024 * 1024
+                elif mem_match3:
+                    current_job['mem_usage'] = 0
+                else:
+                    raise Exception("Unknown memory unit from line: " + line)
+            mem_req_match = re.search(r'Resource_List.mem = (\d+)([a-zA-Z]+)', line)
+            if mem_req_match:
+                val = int(mem_req_match.group(1))
+                unit = mem_req_match.group(2).lower()
+                mem_gb = {'gb': val, 'mb': val / 1024, 'kb': val / (1024 * 1024)}.get(unit, 0)
+                current_job['mem_request_gb'] = mem_gb
+            gpu_match = re.search(r'Resource_List.ngpus = (\d+)', line)
+            if gpu_match:
+                current_job['ngpus'] = int(gpu_match.group(1))
+            walltime_match = re.search(r'resources_used.walltime = (\d+):(\d+):(\d+)', line)
+            if walltime_match:
+                h, m, s = map(int, walltime_match.groups())
+                current_job['walltime_used'] = h * 3600 + m * 60 + s
+                if 'walltime_total' in current_job:
+                    current_job['walltime'] = current_job['walltime_total'] - current_job['walltime_used']
+            cput_match = re.search(r'resources_used.cput = (\d+):(\d+):(\d+)', line)
+            if cput_match:
+                h, m, s = map(int, cput_match.groups())
+                current_job['cput_used'] = h * 3600 + m * 60 + s
+            vmem_match = re.search(r'resources_used.vmem = (\d+)([a-zA-Z]+)', line)
+            if vmem_match:
+                val = int(vmem_match.group(1))
+                unit = vmem_match.group(2).lower()
+                current_job['vmem_used_kb'] = {'kb': val, 'mb': val * 1024, 'gb': val * 1024 * 1024}.get(unit, 0)
+            walltime_match = re.search(r'Resource_List.walltime = (\d+):(\d+):(\d+)', line)
+            if walltime_match:
+                h, m, s = map(int, walltime_match.groups())
+                requested_walltime = h * 3600 + m * 60 + s
+                current_job['walltime_total'] = requested_walltime
+                if 'walltime_used' in current_job:
+                    current_job['walltime'] = requested_walltime - current_job['walltime_used']
+                else:
+                    current_job['walltime'] = requested_walltime
+                current_job['cpu_usage_remaining'] = current_job['ncpus'] * current_job['walltime']
+                if 'ngpus' in current_job:
+                    current_job['gpu_usage_remaining'] = current_job['ngpus'] * current_job['walltime']
+
+        exit_match = re.search(r'Exit_status = (\d+)', line)
+        if exit_match:
+            current_job['exit_status'] = int(exit_match.group(1))
+
+    if current_job:
+        jobs.append(current_job)
+    return jobs
+
+
+def _measure(func, memory=False):
+    """Return (result, seconds, peak bytes or None) for calling *func*.
+
+    Peak memory is measured in a second traced call, since tracemalloc
+    slows allocation-heavy code down by an order of magnitude.
+    """
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    peak = None
+    if memory:
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def _report(label, seconds, peak):
+    mem = f"  peak {peak / 1024 / 1024:7.1f} MB" if peak is not None else ""
+    print(f"{label:<21}{seconds:7.2f} s{mem}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=100000, help="Number of synthetic jobs [default: 100000]")
+    parser.add_argument("--qstat-file", help="Benchmark this qstat -f dump instead of a synthetic one")
+    parser.add_argument("--memory", action="store_true", help="Also report peak Python memory (slow)")
+    args = parser.parse_args()
+
+    mqstat = runpy.run_path(str(REPO / "bin" / "mqstat"))
+
+    tmp = None
+    path = args.qstat_file
+    if path is None:
+        tmp = tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False)
+        with tmp:
+            synthetic_qstat_f(tmp, args.jobs)
+        path = tmp.name
+    try:
+        size_mb = os.path.getsize(path) / 1024 / 1024
+
+        def run_legacy():
+            with open(path) as f:
+                return legacy_parse(f.read())
+
+        old, old_s, old_peak = _measure(run_legacy, args.memory)
+        new, new_s, new_peak = _measure(lambda: mqstat["parse_qstat"](path=path), args.memory)
+
+        assert old == new, "parsers disagree"
+        print(f"{len(new)} jobs, {size_mb:.1f} MB of qstat -f output")
+        _report("legacy regex parser:", old_s, old_peak)
+        _report("streaming parser:", new_s, new_peak)
+        print(f"speedup: {old_s / new_s:.1f}x")
+    finally:
+        if tmp is not None:
+            os.remove(tmp.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""Benchmark ``mqstat --history`` queries on months of 1-minute samples.
+
+Fills a temporary history database the way ``mqstat --record`` run from
+cron every minute would, then times ``print_history`` for each period.
+
+    python3 benchmarks/bench_usage_history.py --days 90
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import runpy
+import tempfile
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parents[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--days", type=int, default=90, help="Days of 1-minute samples to record [default: 90]")
+    args = parser.parse_args()
+
+    mqstat = runpy.run_path(str(REPO / "bin" / "mqstat"))
+    metrics = [metric for metric, _ in mqstat["HISTORY_METRICS"]]
+    rng = random.Random(0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        history = mqstat["UsageHistory"](os.path.join(tmp, "history.sqlite"))
+        now = time.time()
+        samples = args.days * 24 * 60
+        start = time.perf_counter()
+        for i in range(samples):
+            history.record({metric: rng.uniform(0, 100) for metric in metrics}, ts=now - (samples - i) * 60)
+        fill_s = time.perf_counter() - start
+        size_mb = os.path.getsize(history.path) / 1024 / 1024
+        print(f"{samples} samples of {len(metrics)} metrics recorded in {fill_s:.1f} s "
+              f"({fill_s / samples * 1000:.2f} ms each), database {size_mb:.1f} MB")
+
+        for period in ("day", "week", "month"):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                mqstat["print_history"](history, period, now=now)
+            print(f"--history {period:<6} {(time.perf_counter() - start) * 1000:7.1f} ms")
+        history.close()
+
+
+if __name__ == "__main__":
+    main()
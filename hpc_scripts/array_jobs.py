@@ -0,0 +1,203 @@
+"""Compact storage of PBS array subjobs.
+
+``qstat -t`` lists every subjob of an array job (``123[7].server``) with a
+full set of attributes, although subjobs differ from their parent
+(``123[].server``) in little more than state, walltime used and exit status.
+Rather than keep a dict per subjob, parsers fold them into a
+:class:`SubjobStates` attached to the parent job under the ``'subjobs'``
+key. It stores those few fields in flat arrays, which take a few bytes per
+subjob. Per-subjob dicts are only built on demand by
+:meth:`SubjobStates.expand`.
+"""
+
+import array
+import re
+
+SUBJOB_ID_RE = re.compile(r'^(\d+)\[(\d+)\](.*)$')
+
+# Stored in place of an exit status for subjobs that have not finished.
+NO_EXIT_STATUS = -(2 ** 31)
+
+# Subjob states counted as done: expired (finished) subjobs of a running
+# array are in state X, and in job history F.
+DONE_STATES = ('X', 'F', 'C')
+
+# Fields that describe one run of a job rather than what was requested. A
+# subjob standing in for its parent has its own, which must not be copied
+# to every subjob by SubjobStates.expand.
+RUN_FIELDS = ('walltime_used', 'cpupercent', 'exit_status', 'ncpus_used',
+              'vmem_used_kb', 'cput_used', 'start_time', 'obittime')
+
+
+def split_subjob_id(job_id):
+    """Return ``(parent_id, index)`` for a subjob ID such as ``123[7].server``.
+
+    Returns ``None`` for any other job ID, including the parent's own
+    ``123[].server``.
+    """
+    match = SUBJOB_ID_RE.match(job_id)
+    if match is None:
+        return None
+    return f"{match.group(1)}[]{match.group(3)}", int(match.group(2))
+
+
+def short_count(n):
+    """Format a count for a table cell, e.g. 950, 1.5k, 48k."""
+    if n < 1000:
+        return str(n)
+    if n < 10000:
+        # Round down so e.g. 9999 of 10000 done never shows as all done.
+        return f"{int(n / 100) / 10:g}k"
+    return f"{n // 1000}k"
+
+
+class SubjobStates:
+    """Per-subjob state, walltime used, CPU % and exit status of an array job."""
+
+    __slots__ = ('indices', 'states', 'walltime_used', 'cpupercent', 'exit_status')
+
+    def __init__(self):
+        self.indices = array.array('l')
+        self.states = bytearray()
+        self.walltime_used = array.array('l')
+        self.cpupercent = array.array('l')
+        self.exit_status = array.array('l')
+
+    def __len__(self):
+        return len(self.indices)
+
+    def add(self, index, state, walltime_used=0, cpupercent=0, exit_status=None):
+        self.indices.append(index)
+        self.states.append(ord(state[0]) if state else ord('?'))
+        self.walltime_used.append(walltime_used or 0)
+        self.cpupercent.append(cpupercent or 0)
+        self.exit_status.append(NO_EXIT_STATUS if exit_status is None else exit_status)
+
+    def state_counts(self):
+        """Return a dict of subjob state letter -> number of subjobs."""
+        counts = {}
+        for code in self.states:
+            state = chr(code)
+            counts[state] = counts.get(state, 0) + 1
+        return counts
+
+    def done(self):
+        done_codes = {ord(s) for s in DONE_STATES}
+        return sum(1 for code in self.states if code in done_codes)
+
+    def failed(self):
+        return sum(1 for status in self.exit_status if status != NO_EXIT_STATUS and status != 0)
+
+    def summary(self):
+        """Describe progress like ``48k/50k done, 12 failed, 200 running``."""
+        parts = [f"{short_count(self.done())}/{short_count(len(self))} done"]
+        failed = self.failed()
+        if failed:
+            parts.append(f"{short_count(failed)} failed")
+        running = self.state_counts().get('R', 0)
+        if running:
+            parts.append(f"{short_count(running)} running")
+        return ", ".join(parts)
+
+    def expand(self, parent):
+        """Yield a job dict for each subjob, based on the *parent* job dict.
+
+        Request fields are copied from the parent. Walltime and CPU
+        remaining are worked out per subjob the way the parsers do for
+        ordinary jobs.
+        """
+        parent_id = parent['id']
+        prefix, _, suffix = parent_id.partition('[]')
+        template = {key: value for key, value in parent.items() if key != 'subjobs'}
+        for i, index in enumerate(self.indices):
+            job = dict(template)
+            job['id'] = f"{prefix}[{index}]{suffix}"
+            job['array_parent'] = parent_id
+            job['state'] = chr(self.states[i])
+            used = self.walltime_used[i]
+            job['walltime_used'] = used
+            if self.cpupercent[i]:
+                job['cpupercent'] = self.cpupercent[i]
+            else:
+                job.pop('cpupercent', None)
+            if self.exit_status[i] != NO_EXIT_STATUS:
+                job['exit_status'] = self.exit_status[i]
+            else:
+                job.pop('exit_status', None)
+            if 'walltime_total' in job:
+                job['walltime'] = job['walltime_total'] - used
+                job['cpu_usage_remaining'] = job.get('ncpus', 0) * job['walltime']
+                if 'ngpus' in job:
+                    job['gpu_usage_remaining'] = job['ngpus'] * job['walltime']
+            yield job
+
+
+class ArrayJobCollector:
+    """Build a job list in which subjobs are folded into their parent.
+
+    Ordinary and parent jobs are added with :meth:`add_job`, subjobs with
+    :meth:`add_subjob`. The parent of an array usually comes before its
+    subjobs. If it does not, the first subjob stands in for it until the
+    parent's own record arrives.
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self._arrays = {}
+
+    def has_parent(self, parent_id):
+        return parent_id in self._arrays
+
+    def add_job(self, job):
+        """Add *job* and return the dict that now represents it."""
+        job_id = job['id']
+        placeholder = self._arrays.get(job_id)
+        if placeholder is not None:
+            subjobs = placeholder['subjobs']
+            placeholder.clear()
+            placeholder.update(job)
+            placeholder['subjobs'] = subjobs
+            return placeholder
+        if '[]' in job_id:
+            job['subjobs'] = SubjobStates()
+            self._arrays[job_id] = job
+        self.jobs.append(job)
+        return job
+
+    def add_subjob(self, parent_id, index, state, walltime_used=0, cpupercent=0,
+                   exit_status=None, make_parent=None):
+        """Record a subjob of *parent_id*.
+
+        If the parent has not been seen, ``make_parent()`` must return a job
+        dict (usually this subjob parsed in full), which is used as the
+        parent until the real one is added.
+        """
+        parent = self._arrays.get(parent_id)
+        if parent is None:
+            parent = make_parent()
+            for key in RUN_FIELDS:
+                parent.pop(key, None)
+            # Every parser gives a job a memory use, 0 until one is reported.
+            if 'mem_usage' in parent:
+                parent['mem_usage'] = 0
+            if 'walltime_total' in parent:
+                parent['walltime'] = parent['walltime_total']
+            parent['id'] = parent_id
+            parent['state'] = 'B'
+            parent['subjobs'] = SubjobStates()
+            self._arrays[parent_id] = parent
+            self.jobs.append(parent)
+        parent['subjobs'].add(index, state, walltime_used, cpupercent, exit_status)
+
+
+def expand_array_jobs(jobs):
+    """Yield *jobs* with each array parent replaced by its subjobs.
+
+    Jobs without subjobs are passed through unchanged.
+    """
+    for job in jobs:
+        subjobs = job.get('subjobs')
+        if subjobs:
+            yield from subjobs.expand(job)
+        else:
+            yield job
@@ -0,0 +1,77 @@
+"""Ledger of the commands run from an ``mqsub --command-file``.
+
+Each command run by a chunk job appends one line to the ledger: the SHA-1
+of the command line, its exit status, its wall time in seconds, the time it
+finished, and the job that ran it. The ledger is the directory
+``<command file>.ledger`` next to the command file. Each job (and each slot
+of ``--chunk-parallel``) appends to its own shard file in it, so thousands
+of jobs can record commands at once without sharing a lock or a file.
+
+``mqsub --resume`` reads every shard with :func:`read_ledger` and leaves out
+the commands that have already succeeded. ``mqsub --balance`` uses
+:func:`mean_seconds` to estimate how long each command will take.
+"""
+
+import glob
+import hashlib
+import os
+
+# Columns of each line of a shard, tab separated.
+FIELDS = ('hash', 'status', 'seconds', 'finished', 'job_id')
+
+
+def command_hash(command):
+    """Return the hash the job scripts record for *command*.
+
+    Matches ``printf '%s' "$command" | sha1sum`` in bash.
+    """
+    return hashlib.sha1(command.encode()).hexdigest()
+
+
+def ledger_dir(command_file):
+    return os.path.abspath(command_file) + '.ledger'
+
+
+def read_ledger(directory):
+    """Return a list of the records in every shard under *directory*, as dicts.
+
+    A missing directory is an empty ledger. Lines that are incomplete, as
+    when a job is killed while writing one, are skipped.
+    """
+    records = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.tsv'))):
+        with open(path) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != len(FIELDS) or not line.endswith('\n'):
+                    continue
+                try:
+                    status, seconds, finished = int(fields[1]), int(fields[2]), int(fields[3])
+                except ValueError:
+                    continue
+                records.append({
+                    'hash': fields[0],
+                    'status': status,
+                    'seconds': seconds,
+                    'finished': finished,
+                    'job_id': fields[4],
+                })
+    return records
+
+
+def succeeded(records):
+    """Return the hashes of the commands with a record of exit status 0."""
+    return {r['hash'] for r in records if r['status'] == 0}
+
+
+def mean_seconds(records):
+    """Return the mean wall time of each command in *records*, by hash.
+
+    Only successful runs are counted for a command that has any, as a
+    command that failed may have stopped early.
+    """
+    runs = {}
+    for r in records:
+        ok, failed = runs.setdefault(r['hash'], ([], []))
+        (ok if r['status'] == 0 else failed).append(r['seconds'])
+    return {h: sum(ok or failed) / len(ok or failed) for h, (ok, failed) in runs.items()}
@@ -0,0 +1,122 @@
+"""Bounded history of the resource use of running jobs.
+
+Each time ``mqtop`` loads a new ``qstat`` snapshot it sees every running
+job's CPU %, memory and walltime used. :class:`JobSamples` keeps the last
+few of those samples per job in a :class:`SampleRing`, a fixed-size ring
+buffer backed by one flat array, so a session left open for days uses a
+bounded amount of memory per job. The peak memory seen is kept separately,
+so it covers samples that have dropped out of the ring.
+"""
+
+import array
+
+# Samples kept per job.
+CAPACITY = 32
+
+# Values stored for each sample, in order.
+FIELDS = ('time', 'cpupercent', 'mem_kb', 'vmem_kb', 'walltime_used')
+_FIELD_INDEX = {name: i for i, name in enumerate(FIELDS)}
+
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+
+def sparkline(values, width):
+    """Return a sparkline of percentages, averaging *values* into *width* columns.
+
+    Fewer values than *width* give a shorter line, one column per value.
+    """
+    values = list(values)
+    if not values:
+        return ''
+    columns = min(width, len(values))
+    chars = []
+    for c in range(columns):
+        bucket = values[c * len(values) // columns:(c + 1) * len(values) // columns]
+        mean = min(max(sum(bucket) / len(bucket), 0), 100)
+        chars.append(SPARK_CHARS[min(int(mean / 100 * len(SPARK_CHARS)), len(SPARK_CHARS) - 1)])
+    return ''.join(chars)
+
+
+class SampleRing:
+    """The last *capacity* samples of one job, oldest first."""
+
+    __slots__ = ('capacity', 'peak_mem_kb', '_values', '_next')
+
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.peak_mem_kb = 0
+        # Grows to capacity * len(FIELDS) values, then wraps around.
+        self._values = array.array('q')
+        self._next = 0
+
+    def __len__(self):
+        return len(self._values) // len(FIELDS)
+
+    def add(self, time, cpupercent, mem_kb, vmem_kb, walltime_used):
+        sample = (int(time), cpupercent, mem_kb, vmem_kb, walltime_used)
+        if len(self) < self.capacity:
+            self._values.extend(sample)
+        else:
+            start = self._next * len(FIELDS)
+            self._values[start:start + len(FIELDS)] = array.array('q', sample)
+            self._next = (self._next + 1) % self.capacity
+        self.peak_mem_kb = max(self.peak_mem_kb, mem_kb)
+
+    def series(self, field):
+        """Return the values of *field*, oldest first."""
+        values = self._values[_FIELD_INDEX[field]::len(FIELDS)].tolist()
+        return values[self._next:] + values[:self._next]
+
+    def last(self, field):
+        if not self._values:
+            return None
+        newest = (self._next - 1) % len(self)
+        return self._values[newest * len(FIELDS) + _FIELD_INDEX[field]]
+
+
+class JobSamples:
+    """A :class:`SampleRing` for each job seen running, by job ID.
+
+    :attr:`revision` goes up whenever a sample is added, so callers can
+    tell when anything derived from the samples is out of date.
+    """
+
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.revision = 0
+        self._rings = {}
+
+    def __len__(self):
+        return len(self._rings)
+
+    def get(self, job_id):
+        return self._rings.get(job_id)
+
+    def record(self, jobs, now):
+        """Add a sample for each running job in *jobs*, parsed as by ``mqtop``.
+
+        A job whose walltime used has not changed since its last sample is
+        skipped, as it comes from the same snapshot.
+        """
+        for job in jobs:
+            if job.get('state') != 'R':
+                continue
+            ring = self._rings.get(job['id'])
+            walltime_used = job.get('walltime_used', 0)
+            if ring is None:
+                ring = self._rings[job['id']] = SampleRing(self.capacity)
+            elif ring.last('walltime_used') == walltime_used:
+                continue
+            ring.add(
+                now,
+                job.get('cpupercent', 0),
+                job.get('mem_usage', 0),
+                job.get('vmem_used_kb', 0),
+                walltime_used,
+            )
+            self.revision += 1
+
+    def prune(self, job_ids):
+        """Forget the samples of jobs not in *job_ids*."""
+        for job_id in [j for j in self._rings if j not in job_ids]:
+            del self._rings[job_id]
@@ -0,0 +1,150 @@
+"""Line-oriented random access to large, growing log files.
+
+Job logs can be many gigabytes on a network filesystem, so :class:`LogFile`
+never reads a whole file. Lines are found by reading fixed-size chunks
+forwards or backwards from a byte offset, which makes the end of a file as
+cheap to show as its start. Positions are byte offsets of line starts, so
+they stay valid while the file grows. Searches scan the file a chunk at a
+time.
+"""
+
+import os
+
+CHUNK_SIZE = 1 << 16
+
+# Lines longer than this are shown as several lines, so a file without
+# newlines never has to be read in one piece.
+MAX_LINE = 1 << 16
+
+# Control characters are shown as '?', except tab, which callers expand.
+_CONTROL = {c: '?' for c in list(range(32)) + [127] if c != 9}
+
+
+def display_text(line):
+    """Decode a line of log bytes for display."""
+    text = line.rstrip(b'\r').decode('utf-8', 'replace').expandtabs()
+    return text.translate(_CONTROL)
+
+
+class LogFile:
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self._fh = open(path, 'rb')
+        self.size = 0
+        self.refresh()
+
+    def close(self):
+        self._fh.close()
+
+    def refresh(self):
+        """Pick up the file's current size. Returns ``True`` if it changed."""
+        size = os.fstat(self._fh.fileno()).st_size
+        changed = size != self.size
+        self.size = size
+        return changed
+
+    def _read(self, offset, length):
+        self._fh.seek(offset)
+        return self._fh.read(length)
+
+    def line_start(self, offset):
+        """Return the offset of the start of the line holding byte *offset*."""
+        pos = min(offset, self.size)
+        limit = max(0, pos - MAX_LINE)
+        while pos > limit:
+            start = max(limit, pos - self.chunk_size)
+            newline = self._read(start, pos - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            pos = start
+        return limit
+
+    def lines(self, offset, count):
+        """Return up to *count* ``(offset, line)`` pairs starting at *offset*.
+
+        Lines are bytes without their newline. A last line that has no
+        newline yet is included.
+        """
+        out = []
+        pos = offset
+        pending = b''
+        while len(out) < count and pos < self.size:
+            data = pending + self._read(pos, min(self.chunk_size, self.size - pos))
+            base = pos - len(pending)
+            pos += len(data) - len(pending)
+            start = 0
+            while len(out) < count:
+                newline = data.find(b'\n', start, start + MAX_LINE + 1)
+                if newline < 0:
+                    if len(data) - start > MAX_LINE:
+                        newline = start + MAX_LINE
+                        out.append((base + start, data[start:newline]))
+                        start = newline
+                        continue
+                    break
+                out.append((base + start, data[start:newline]))
+                start = newline + 1
+            pending = data[start:]
+        if len(out) < count and pending:
+            out.append((self.size - len(pending), pending))
+        return out
+
+    def previous_line(self, offset):
+        """Return the start of the line before the one starting at *offset*."""
+        if offset <= 0:
+            return None
+        return self.line_start(offset - 1)
+
+    def next_line(self, offset):
+        """Return the start of the line after the one starting at *offset*."""
+        following = self.lines(offset, 2)
+        return following[1][0] if len(following) == 2 else None
+
+    def tail(self, count):
+        """Return the start of the first of the last *count* lines."""
+        end = self.size
+        if end and self._read(end - 1, 1) == b'\n':
+            end -= 1
+        offset = self.line_start(end)
+        for _ in range(count - 1):
+            previous = self.previous_line(offset)
+            if previous is None:
+                break
+            offset = previous
+        return offset
+
+    def find(self, needle, start, backwards=False, ignore_case=False):
+        """Return the offset of the next match of bytes *needle*, or ``None``.
+
+        Searches forwards from *start*, or backwards from just before it.
+        """
+        if not needle:
+            return None
+        if ignore_case:
+            needle = needle.lower()
+        overlap = len(needle) - 1
+        step = max(self.chunk_size, len(needle))
+        if not backwards:
+            pos = start
+            while pos < self.size:
+                data = self._read(pos, step + overlap)
+                if ignore_case:
+                    data = data.lower()
+                found = data.find(needle)
+                if found >= 0:
+                    return pos + found
+                pos += step
+            return None
+        end = start
+        while end > 0:
+            begin = max(0, end - step)
+            data = self._read(begin, end - begin + overlap)
+            if ignore_case:
+                data = data.lower()
+            # Only matches starting before *end*; later ones were searched.
+            found = data.rfind(needle, 0, end - begin + overlap)
+            if found >= 0:
+                return begin + found
+            end = begin
+        return None
@@ -0,0 +1,220 @@
+"""Copy directory trees with several streams at once.
+
+A single ``cp -r`` copies one file at a time, so on a parallel filesystem a
+directory of many small files is bound by the latency of each open and
+close, and one large file by the bandwidth of one stream. :func:`copy_tree`
+first lists everything to copy in a :class:`Manifest`, then shares the work
+out between a pool of streams by file size:
+
+* small files go in batches, each copied by a ``tar`` pipe, so a stream
+  handles many files per process started;
+* medium files are copied whole, one per stream;
+* large files are split into pieces copied at the same time.
+
+Afterwards the size of every copied file is checked against the manifest,
+and the throughput is reported on stderr, which goes to the job's log.
+
+Job scripts written by ``mqsub`` run this module to stage data in and out::
+
+    python3 -m hpc_scripts.parallel_copy SOURCE DESTINATION_DIR
+    python3 -m hpc_scripts.parallel_copy --contents --no-dereference SOURCE DESTINATION_DIR
+"""
+
+import argparse
+import collections
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of copies running at once.
+STREAMS = 8
+
+# Files smaller than this are copied in tar batches.
+SMALL_FILE = 1 << 20
+# Most files and bytes in one tar batch.
+BATCH_FILES = 1000
+BATCH_BYTES = 256 << 20
+
+# Files at least this large are copied in pieces of PIECE_BYTES.
+LARGE_FILE = 1 << 30
+PIECE_BYTES = 256 << 20
+
+BUFFER_BYTES = 8 << 20
+
+# files: (path, size, mtime_ns) of each file; dirs: each directory; links:
+# (path, target) of each symbolic link kept as a link. Paths are relative
+# to the source, and sorted.
+Manifest = collections.namedtuple('Manifest', ['files', 'dirs', 'links'])
+
+
+def build_manifest(source, dereference=True):
+    """Return the :class:`Manifest` of *source*, a directory or file.
+
+    With *dereference*, symbolic links are followed as by ``cp -r -L``.
+    Otherwise they are listed in ``links``. A *source* that is a file gives
+    one file with path ``''``.
+    """
+    if not os.path.isdir(source):
+        st = os.stat(source)
+        return Manifest([('', st.st_size, st.st_mtime_ns)], [], [])
+    files, dirs, links = [], [], []
+    for root, subdirs, names in os.walk(source, followlinks=dereference):
+        relroot = os.path.relpath(root, source)
+        if relroot != '.':
+            dirs.append(relroot)
+        if not dereference:
+            for name in list(subdirs):
+                if os.path.islink(os.path.join(root, name)):
+                    subdirs.remove(name)
+                    names.append(name)
+        for name in names:
+            path = os.path.join(root, name)
+            relpath = os.path.relpath(path, source)
+            if not dereference and os.path.islink(path):
+                links.append((relpath, os.readlink(path)))
+                continue
+            st = os.stat(path)
+            files.append((relpath, st.st_size, st.st_mtime_ns))
+    return Manifest(sorted(files), sorted(dirs), sorted(links))
+
+
+def _join(root, path):
+    # The path of a source that is a file is ''.
+    return os.path.join(root, path) if path else root
+
+
+def _copy_batch(source, destination, paths):
+    create = subprocess.Popen(
+        ['tar', '-C', source, '-c', '-h', '-f', '-', '--null', '-T', '-'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    extract = subprocess.Popen(['tar', '-C', destination, '-x', '-f', '-'], stdin=create.stdout)
+    create.stdout.close()
+    create.stdin.write(b'\0'.join(os.fsencode(p) for p in paths))
+    create.stdin.close()
+    if create.wait() or extract.wait():
+        raise Exception('tar failed copying {} files from {} to {}'.format(len(paths), source, destination))
+
+
+def _copy_file(source, destination):
+    shutil.copyfile(source, destination)
+    shutil.copymode(source, destination)
+
+
+def _copy_piece(source, destination, offset, length):
+    with open(source, 'rb') as fin, open(destination, 'r+b') as fout:
+        fin.seek(offset)
+        fout.seek(offset)
+        while length:
+            data = fin.read(min(BUFFER_BYTES, length))
+            if not data:
+                raise Exception('{} is shorter than expected'.format(source))
+            fout.write(data)
+            length -= len(data)
+
+
+def plan(manifest):
+    """Split the files of *manifest* into tasks, most bytes first.
+
+    Each task is ``(kind, bytes, args)``: ``('batch', n, [path, ...])``,
+    ``('file', n, path)`` or ``('piece', n, (path, offset))``.
+    """
+    tasks = []
+    batch, batch_bytes = [], 0
+    for path, size, _ in manifest.files:
+        if size >= LARGE_FILE:
+            for offset in range(0, size, PIECE_BYTES):
+                tasks.append(('piece', min(PIECE_BYTES, size - offset), (path, offset)))
+        elif size >= SMALL_FILE or path == '':
+            tasks.append(('file', size, path))
+        else:
+            batch.append(path)
+            batch_bytes += size
+            if len(batch) >= BATCH_FILES or batch_bytes >= BATCH_BYTES:
+                tasks.append(('batch', batch_bytes, batch))
+                batch, batch_bytes = [], 0
+    if batch:
+        tasks.append(('batch', batch_bytes, batch))
+    tasks.sort(key=lambda t: -t[1])
+    return tasks
+
+
+def verify(manifest, target):
+    """Raise an exception unless every file of *manifest* under *target* has the expected size."""
+    for path, size, _ in manifest.files:
+        copied = _join(target, path)
+        try:
+            copied_size = os.stat(copied).st_size
+        except OSError:
+            copied_size = None
+        if copied_size != size:
+            raise Exception('{} has size {}, but its source had size {}'.format(copied, copied_size, size))
+
+
+def copy_tree(source, destination, manifest=None, streams=STREAMS, contents=False, dereference=True, log=sys.stderr):
+    """Copy *source* into the directory *destination*, as ``cp -r -L`` would.
+
+    With *contents*, the entries of *source* are copied into *destination*
+    rather than *source* itself. Returns the number of bytes copied.
+    """
+    start = time.time()
+    source = os.path.abspath(source)
+    if manifest is None:
+        manifest = build_manifest(source, dereference)
+    target = destination if contents else os.path.join(destination, os.path.basename(source))
+
+    if os.path.isdir(source):
+        os.makedirs(target, exist_ok=True)
+        for path in manifest.dirs:
+            os.makedirs(os.path.join(target, path), exist_ok=True)
+        for path, link in manifest.links:
+            if os.path.lexists(os.path.join(target, path)):
+                os.remove(os.path.join(target, path))
+            os.symlink(link, os.path.join(target, path))
+    tasks = plan(manifest)
+    for path, size, _ in manifest.files:
+        if size >= LARGE_FILE:
+            # Pieces are written into a file of the full size.
+            with open(_join(target, path), 'wb') as f:
+                f.truncate(size)
+
+    def run(task):
+        kind, size, arg = task
+        if kind == 'batch':
+            _copy_batch(source, target, arg)
+        elif kind == 'file':
+            _copy_file(_join(source, arg), _join(target, arg))
+        else:
+            path, offset = arg
+            _copy_piece(_join(source, path), _join(target, path), offset, size)
+
+    with ThreadPoolExecutor(max_workers=streams) as pool:
+        for _ in pool.map(run, tasks):
+            pass
+    for path, size, _ in manifest.files:
+        if size >= LARGE_FILE:
+            shutil.copymode(_join(source, path), _join(target, path))
+    verify(manifest, target)
+
+    total = sum(size for _, size, _ in manifest.files)
+    seconds = max(time.time() - start, 1e-6)
+    print('Copied {} files ({:.2f} GB) from {} to {} in {:.1f} seconds, {:.1f} MB/s with {} streams'.format(
+        len(manifest.files), total / 1e9, source, target, seconds, total / 1e6 / seconds, streams), file=log)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Copy a file or directory with several streams at once')
+    parser.add_argument('source')
+    parser.add_argument('destination', help='Directory to copy into')
+    parser.add_argument('--contents', action='store_true', help='Copy what is in SOURCE, rather than SOURCE itself')
+    parser.add_argument('--no-dereference', action='store_true', help='Copy symbolic links as links, rather than what they point to')
+    parser.add_argument('--streams', type=int, default=STREAMS, help='Copies to run at once [default: {}]'.format(STREAMS))
+    args = parser.parse_args()
+    copy_tree(args.source, args.destination, streams=args.streams, contents=args.contents, dereference=not args.no_dereference)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+"""Short-lived on-disk snapshots of PBS query output.
+
+Many hpc_scripts tools running on the same login node ask the PBS server the
+same questions. :class:`PbsSnapshot` lets the first caller run a query and
+store its output, and later callers read that output instead while it is
+younger than the TTL.
+
+The snapshot directory is shared by everyone on the node, and is created
+sticky and world-writable like ``/tmp``. Each user writes their own copy of
+a snapshot, ``<name>.<uid>``, written to a temporary file and moved into
+place with ``os.replace``, so readers never see a partial file. Readers use
+the newest fresh copy owned by the reader, by root or by a trusted service
+account (``HPC_SCRIPTS_SNAPSHOT_OWNER``), so no other user can feed them a
+forged snapshot. To share snapshots between users, run the refresher below
+from cron as root or as the service account::
+
+    * * * * * python3 -m hpc_scripts.pbs_snapshot qstat qstat_history pbsnodes
+
+Refreshing takes an exclusive ``flock`` on the user's own lock file, so a
+second process of the same user that wants the same refresh waits and then
+reuses the result instead of querying the server again. The wait is bounded
+by the caller's timeout, after which the caller is expected to fall back to
+a live query.
+
+Besides the whole-cluster snapshots in :data:`SNAPSHOT_COMMANDS`,
+:meth:`PbsSnapshot.job` keeps a snapshot of ``qstat -x -f`` for a single
+job, for tools such as ``mqsub``, ``mqwait`` and ``snakemake_mqstat`` that
+poll particular jobs.
+
+Settings are read from the environment:
+
+``HPC_SCRIPTS_SNAPSHOT_TTL``
+    Maximum age of a snapshot in seconds. ``0`` disables the cache
+    [default: 30].
+``HPC_SCRIPTS_SNAPSHOT_DIR``
+    Where snapshots are kept [default: ``/tmp/hpc_scripts_snapshot``].
+``HPC_SCRIPTS_SNAPSHOT_OWNER``
+    Comma-separated users, besides root and the reader, whose snapshots are
+    trusted [default: none].
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import pwd
+import re
+import shlex
+import subprocess
+import tempfile
+import time
+
+DEFAULT_TTL = 30
+
+# Seconds to wait for another process's refresh when the caller gives no
+# timeout.
+LOCK_WAIT = 60
+LOCK_POLL_INTERVAL = 0.05
+
+# Seconds after which this user's snapshots of single jobs are deleted.
+JOB_SNAPSHOT_EXPIRY = 3600
+
+# Snapshot name -> command whose output it holds.
+SNAPSHOT_COMMANDS = {
+    'qstat': 'qstat -f -t -F json',
+    'qstat_history': 'qstat -xf -t -F json',
+    'pbsnodes': 'pbsnodes -a',
+}
+
+JOB_SNAPSHOT_PREFIX = 'job.'
+JOB_SNAPSHOT_COMMAND = 'qstat -x -f {} -F json'
+JOB_ID = re.compile(r'^[\w.\[\]-]+$')
+
+
+def _trusted_uids():
+    uids = {0, os.getuid()}
+    for owner in os.environ.get('HPC_SCRIPTS_SNAPSHOT_OWNER', '').split(','):
+        owner = owner.strip()
+        if owner.isdigit():
+            uids.add(int(owner))
+        elif owner:
+            try:
+                uids.add(pwd.getpwnam(owner).pw_uid)
+            except KeyError:
+                pass
+    return uids
+
+
+class PbsSnapshot:
+    def __init__(self, directory=None, ttl=None):
+        if directory is None:
+            directory = os.environ.get(
+                'HPC_SCRIPTS_SNAPSHOT_DIR',
+                os.path.join(tempfile.gettempdir(), 'hpc_scripts_snapshot'))
+        if ttl is None:
+            try:
+                ttl = float(os.environ.get('HPC_SCRIPTS_SNAPSHOT_TTL', DEFAULT_TTL))
+            except ValueError:
+                ttl = DEFAULT_TTL
+        self.directory = directory
+        self.ttl = ttl
+        self.trusted = _trusted_uids()
+        self._json = {}
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def path(self, name):
+        """Path of this user's copy of snapshot *name*."""
+        return os.path.join(self.directory, '{}.{}'.format(name, os.getuid()))
+
+    def _command(self, name):
+        if name.startswith(JOB_SNAPSHOT_PREFIX):
+            return JOB_SNAPSHOT_COMMAND.format(name[len(JOB_SNAPSHOT_PREFIX):])
+        return SNAPSHOT_COMMANDS[name]
+
+    def _fresh_path(self, name):
+        """Return the path of the newest fresh, trusted copy of snapshot *name*, or ``None``."""
+        try:
+            entries = os.listdir(self.directory)
+        except OSError:
+            return None
+        now = time.time()
+        best = None
+        for entry in entries:
+            prefix, _, uid = entry.rpartition('.')
+            if prefix != name or not uid.isdigit():
+                continue
+            path = os.path.join(self.directory, entry)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            # Only a copy written by a trusted user, named after that user
+            # and not dated in the future, is used.
+            age = now - st.st_mtime
+            if st.st_uid != int(uid) or st.st_uid not in self.trusted or not 0 <= age < self.ttl:
+                continue
+            if best is None or st.st_mtime > best[0]:
+                best = (st.st_mtime, path)
+        return best and best[1]
+
+    def age(self, name):
+        """Seconds since the newest copy of snapshot *name* was written, or ``None`` if none is fresh."""
+        path = self._fresh_path(name)
+        if path is None:
+            return None
+        try:
+            return time.time() - os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def is_fresh(self, name):
+        return self._fresh_path(name) is not None
+
+    def _read(self, name):
+        """Return ``(path, text)`` of the newest fresh copy of snapshot *name*, or ``None``."""
+        if not self.enabled:
+            return None
+        path = self._fresh_path(name)
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                return path, f.read()
+        except OSError:
+            return None
+
+    def read(self, name):
+        """Return the text of snapshot *name* if it is fresh, else ``None``."""
+        found = self._read(name)
+        return found and found[1]
+
+    def get(self, name, timeout=None, refresh=True):
+        """Return the output of snapshot *name*'s command.
+
+        A fresh snapshot is read from disk. Otherwise, with *refresh*, the
+        command is run under the snapshot lock and its output stored for
+        later callers. Returns ``None`` if the cache is disabled or unusable,
+        if the command fails, if the lock is not free within *timeout* (or
+        ``LOCK_WAIT``) seconds, or if there is no fresh snapshot and not
+        *refresh*, so the caller can fall back to a live query. Raises
+        ``subprocess.TimeoutExpired`` if the command runs past *timeout*.
+        """
+        found = self._get(name, timeout, refresh)
+        return found and found[1]
+
+    def _get(self, name, timeout, refresh):
+        if not self.enabled:
+            return None
+        found = self._read(name)
+        if found is not None or not refresh:
+            return found
+        try:
+            return self._refresh(name, timeout)
+        except OSError:
+            return None
+
+    def json(self, name, timeout=None, refresh=True):
+        """Like :meth:`get`, but decode the snapshot as JSON.
+
+        The decoded object is reused within this process for as long as the
+        snapshot file is unchanged.
+        """
+        found = self._get(name, timeout, refresh)
+        if found is None:
+            return None
+        path, text = found
+        try:
+            key = (path, os.stat(path).st_mtime)
+        except OSError:
+            key = None
+        cached = self._json.get(name)
+        if cached is not None and key is not None and cached[0] == key:
+            return cached[1]
+        try:
+            data = json.loads(text, strict=False)
+        except ValueError:
+            return None
+        self._json[name] = (key, data)
+        return data
+
+    def job(self, job_id, timeout=None):
+        """Return the ``qstat -x -f -F json`` record of *job_id*, or ``None``.
+
+        As with :meth:`get`, ``None`` means the caller should query PBS
+        itself.
+        """
+        if not JOB_ID.match(job_id):
+            return None
+        if self.enabled:
+            self._prune()
+        data = self.json(JOB_SNAPSHOT_PREFIX + job_id, timeout=timeout)
+        if data is None:
+            return None
+        return (data.get('Jobs') or {}).get(job_id)
+
+    def _prune(self):
+        """Delete this user's snapshots of single jobs that nobody has refreshed for a while."""
+        try:
+            entries = os.listdir(self.directory)
+        except OSError:
+            return
+        cutoff = time.time() - JOB_SNAPSHOT_EXPIRY
+        for entry in entries:
+            if not entry.lstrip('.').startswith(JOB_SNAPSHOT_PREFIX):
+                continue
+            path = os.path.join(self.directory, entry)
+            try:
+                st = os.lstat(path)
+                if st.st_uid == os.getuid() and st.st_mtime < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _make_directory(self):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+                os.chmod(self.directory, 0o1777)
+            except FileExistsError:
+                pass
+
+    def _lock(self, name, deadline):
+        """Take this user's lock on snapshot *name*, waiting until *deadline*.
+
+        Returns the locked file descriptor, or ``None`` if the deadline
+        passed first.
+        """
+        lock_path = os.path.join(self.directory, '.{}.{}.lock'.format(name, os.getuid()))
+        fd = os.open(lock_path, os.O_RDONLY | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                if time.time() >= deadline:
+                    os.close(fd)
+                    return None
+                time.sleep(LOCK_POLL_INTERVAL)
+
+    def _refresh(self, name, timeout):
+        deadline = time.time() + (timeout if timeout is not None else LOCK_WAIT)
+        self._make_directory()
+        lock = self._lock(name, deadline)
+        if lock is None:
+            return None
+        try:
+            # Another process may have refreshed while we waited.
+            found = self._read(name)
+            if found is not None:
+                return found
+            path = self.path(name)
+            fd, tmp_path = tempfile.mkstemp(prefix='.{}.'.format(name), suffix='.tmp', dir=self.directory)
+            try:
+                with os.fdopen(fd, 'w') as tmp:
+                    proc = subprocess.run(
+                        shlex.split(self._command(name)),
+                        stdout=tmp, stderr=subprocess.DEVNULL,
+                        timeout=None if timeout is None else max(deadline - time.time(), 0.1))
+                if proc.returncode != 0:
+                    return None
+                # Readable by the other users of the directory.
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, path)
+                tmp_path = None
+            except OSError:
+                return None
+            finally:
+                if tmp_path is not None:
+                    os.remove(tmp_path)
+            with open(path) as f:
+                return path, f.read()
+        finally:
+            os.close(lock)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Refresh shared snapshots of PBS query output')
+    parser.add_argument('names', nargs='+', choices=sorted(SNAPSHOT_COMMANDS), help='Snapshots to refresh if stale')
+    parser.add_argument('--timeout', type=float, default=LOCK_WAIT,
+                        help='Seconds to allow each refresh, including waiting for the lock [default: {}]'.format(LOCK_WAIT))
+    args = parser.parse_args()
+    snapshot = PbsSnapshot()
+    for name in args.names:
+        try:
+            snapshot.get(name, timeout=args.timeout)
+        except subprocess.TimeoutExpired:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Stream jobs out of ``qstat -F json`` output without loading all of it.
+
+A cluster-wide ``qstat -f -F json`` snapshot can be hundreds of megabytes,
+and ``json.load`` turns that into gigabytes of Python objects when most
+callers want a single user's jobs. :func:`iter_jobs` reads the
+``{"Jobs": {id: {...}, ...}}`` document a chunk at a time. It finds where
+each job ends by jumping from brace to brace with a regular expression, and
+only decodes the jobs that pass its filter. Memory use is bounded by the
+chunk size plus the largest job.
+"""
+
+import json
+import re
+
+CHUNK_SIZE = 1 << 20
+
+_STRING = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+# An object with no objects inside it, such as a job's Resource_List.
+_FLAT_OBJECT = r'\{[^"{}]*(?:' + _STRING + r'[^"{}]*)*\}'
+
+# Everything up to the next brace that is not inside a string or a flat
+# object. Stops before a string or object cut off by the end of the buffer.
+_SKIP_RE = re.compile(r'[^"{}]*(?:(?:' + _STRING + '|' + _FLAT_OBJECT + r')[^"{}]*)*')
+_JOBS_RE = re.compile(r'"Jobs"\s*:\s*\{')
+_JOB_KEY_RE = re.compile(r'\s*,?\s*(' + _STRING + r')\s*:\s*\{')
+_JOBS_END_RE = re.compile(r'\s*\}')
+_EUSER_RE = re.compile(r'"euser"\s*:\s*(' + _STRING + ')')
+
+
+class _Buffer:
+    """Text read from *fh* so far, less what has been consumed."""
+
+    def __init__(self, fh, chunk_size):
+        self.fh = fh
+        self.chunk_size = chunk_size
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Read another chunk, dropping consumed text.
+
+        Positions are relative to :attr:`pos`, which is reset to 0. Returns
+        the old :attr:`pos`, which callers subtract from positions they hold.
+        """
+        if self.eof:
+            raise ValueError('unexpected end of qstat JSON')
+        chunk = self.fh.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+        shift = self.pos
+        self.text = self.text[self.pos:] + chunk
+        self.pos = 0
+        return shift
+
+
+def _object_end(buf, start):
+    """Return the index just past the object whose ``{`` is at *start*."""
+    depth = 1
+    p = start + 1
+    while True:
+        p = _SKIP_RE.match(buf.text, p).end()
+        if p < len(buf.text) and buf.text[p] != '"':
+            if buf.text[p] == '{':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return p + 1, start
+            p += 1
+            continue
+        # The buffer ends inside this object.
+        shift = buf.fill()
+        p -= shift
+        start -= shift
+
+
+def iter_jobs(fh, euser=None, chunk_size=CHUNK_SIZE):
+    """Yield ``(job_id, job)`` for each job in the qstat JSON read from *fh*.
+
+    With *euser*, jobs of other users are skipped without being decoded.
+    Raises ``ValueError`` if the document is cut short or is not laid out
+    as qstat writes it.
+    """
+    buf = _Buffer(fh, chunk_size)
+    while True:
+        match = _JOBS_RE.search(buf.text, buf.pos)
+        if match:
+            buf.pos = match.end()
+            break
+        if buf.eof:
+            return
+        # Keep enough to match a "Jobs" key cut off by the end of the chunk.
+        buf.pos = max(buf.pos, len(buf.text) - 64)
+        buf.fill()
+
+    user_text = None if euser is None else json.dumps(euser, ensure_ascii=False)
+    while True:
+        match = _JOB_KEY_RE.match(buf.text, buf.pos)
+        if match is None:
+            if _JOBS_END_RE.match(buf.text, buf.pos):
+                return
+            buf.fill()
+            continue
+        key = match.group(1)
+        end, start = _object_end(buf, match.end() - 1)
+        buf.pos = end
+        if user_text is not None:
+            if buf.text.find(user_text, start, end) < 0:
+                continue
+            found = _EUSER_RE.search(buf.text, start, end)
+            if found is None or json.loads(found.group(1)) != euser:
+                continue
+        job_id = key[1:-1] if '\\' not in key else json.loads(key)
+        yield job_id, json.loads(buf.text[start:end], strict=False)
@@ -0,0 +1,324 @@
+"""Node-local cache of data staged by ``mqsub --scratch-data`` and ``--tmp-data``.
+
+Chunk jobs often stage the same large database, and several of them may run
+on one node at a time. :class:`StageCache` keeps one copy of each source on
+the node. The copy is keyed by the source path and a manifest of the size
+and modification time of every file under it, so a changed source is copied
+again rather than served stale.
+
+Layout of the cache directory::
+
+    .lock                 flock held while the entries are examined or changed
+    <key>/data/<name>     the staged copy of source <name>
+    <key>/size            bytes in the copy
+    <key>/copying         pid of the process copying the data, until complete
+    <key>/complete        present once the copy is whole
+    <key>/refs/<ref>      one per job using the copy, holding the job's pid
+
+A job takes a reference to an entry with :meth:`StageCache.acquire` and drops
+it with :meth:`StageCache.release`. A reference whose process has gone, e.g.
+because the job was killed, does not count. A new copy must leave
+``MIN_FREE_FRACTION`` of the filesystem free, counting what copies still in
+progress will write, so the caches of several users on one disk are all
+bounded by what is actually free. To make room, complete entries with no
+references are evicted, least recently used first. If there is still no
+room, nothing is copied and :meth:`StageCache.acquire` returns ``None``.
+Copies are made read-only, as a job writing into one would change the data
+of every other job using it.
+
+Job scripts written by ``mqsub`` run this file::
+
+    python3 -m hpc_scripts.stage_cache acquire --cache DIR --ref JOBID --pid PID SOURCE
+    python3 -m hpc_scripts.stage_cache release --cache DIR --ref JOBID [--evict]
+
+``acquire`` prints the path of the staged copy, or exits with status
+``NO_ROOM`` if there is no room for it, so the job can make a copy of its
+own. ``release --evict`` also deletes the entries no job is using, for
+caches that should not outlive the jobs. Sources are copied with
+:func:`hpc_scripts.parallel_copy.copy_tree`.
+"""
+
+import argparse
+import fcntl
+import hashlib
+import os
+import shutil
+import stat
+import sys
+import time
+
+from hpc_scripts.parallel_copy import build_manifest, copy_tree
+
+# Least of the filesystem left free after a new copy.
+MIN_FREE_FRACTION = 0.1
+
+# Exit status of acquire when there is no room for the copy.
+NO_ROOM = 3
+
+# Seconds between checks on another process copying the same source.
+POLL_INTERVAL = 5
+
+
+def cache_key(source, manifest):
+    digest = hashlib.sha1(os.path.abspath(source).encode())
+    for path, size, mtime_ns in manifest.files:
+        digest.update('\0{}\0{}\0{}'.format(path, size, mtime_ns).encode())
+    return digest.hexdigest()
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def make_read_only(path):
+    """Remove write permission from *path* and everything under it."""
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            child = os.path.join(root, name)
+            if not os.path.islink(child):
+                os.chmod(child, stat.S_IMODE(os.stat(child).st_mode) & ~0o222)
+        os.chmod(root, stat.S_IMODE(os.stat(root).st_mode) & ~0o222)
+
+
+def delete(path):
+    """Delete *path*, including copies made read-only by :func:`make_read_only`."""
+    for root, dirs, files in os.walk(path):
+        try:
+            os.chmod(root, 0o700)
+        except OSError:
+            pass
+    shutil.rmtree(path, ignore_errors=True)
+
+
+class StageCache:
+    def __init__(self, directory, max_bytes=None):
+        """*max_bytes* optionally limits the bytes of all entries, as well as the free space."""
+        self.directory = directory
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def _lock(self):
+        fd = os.open(os.path.join(self.directory, '.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def _entry(self, key, *parts):
+        return os.path.join(self.directory, key, *parts)
+
+    def _keys(self):
+        return [k for k in os.listdir(self.directory) if not k.startswith('.')]
+
+    def _live_refs(self, key):
+        refs = []
+        try:
+            names = os.listdir(self._entry(key, 'refs'))
+        except FileNotFoundError:
+            return refs
+        for name in names:
+            try:
+                with open(self._entry(key, 'refs', name)) as f:
+                    pid = int(f.read())
+            except (OSError, ValueError):
+                continue
+            if pid_alive(pid):
+                refs.append(name)
+        return refs
+
+    def _size(self, key):
+        try:
+            with open(self._entry(key, 'size')) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def _last_used(self, key):
+        try:
+            return os.stat(self._entry(key, 'refs')).st_mtime
+        except OSError:
+            return 0
+
+    def _copier(self, key):
+        """Return the pid copying entry *key*, 0 if it has died, or None if the copy is complete."""
+        if os.path.exists(self._entry(key, 'complete')):
+            return None
+        try:
+            with open(self._entry(key, 'copying')) as f:
+                pid = int(f.read())
+        except (OSError, ValueError):
+            return 0
+        return pid if pid_alive(pid) else 0
+
+    def _add_ref(self, key, ref, pid):
+        os.makedirs(self._entry(key, 'refs'), exist_ok=True)
+        with open(self._entry(key, 'refs', ref), 'w') as f:
+            f.write(str(pid))
+        # The mtime of the refs directory is when the entry was last used.
+        os.utime(self._entry(key, 'refs'))
+
+    def _remove(self, key):
+        """Move entry *key* out of the way; the caller deletes it after unlocking."""
+        doomed = os.path.join(self.directory, '.evicted.{}.{}'.format(key, os.getpid()))
+        os.rename(self._entry(key), doomed)
+        return doomed
+
+    def _abandoned(self):
+        """Return the paths left by processes that died while deleting an evicted entry."""
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.startswith('.evicted.') and not pid_alive(int(name.rsplit('.', 1)[1]))]
+
+    def _unused(self):
+        """Return the complete entries no live job refers to, least recently used first."""
+        return sorted(
+            (k for k in self._keys() if self._copier(k) is None and not self._live_refs(k)),
+            key=self._last_used)
+
+    def _make_room(self, size):
+        """Pick entries to evict so that *size* more bytes fit.
+
+        Returns the paths to delete, and whether there is room once they are
+        gone. Nothing is evicted if that would not make enough room.
+        """
+        keys = self._keys()
+        used = sum(self._size(k) for k in keys)
+        st = os.statvfs(self.directory)
+        # Copies in progress have yet to write some of their bytes.
+        pending = sum(self._size(k) for k in keys if self._copier(k))
+        spare = st.f_bavail * st.f_frsize - pending - int(st.f_blocks * st.f_frsize * MIN_FREE_FRACTION)
+
+        def fits(freed):
+            return size <= spare + freed and (self.max_bytes is None or used - freed + size <= self.max_bytes)
+
+        evict, freed = [], 0
+        for key in self._unused():
+            if fits(freed):
+                break
+            evict.append(key)
+            freed += self._size(key)
+        if not fits(freed):
+            return self._abandoned(), False
+        return self._abandoned() + [self._remove(k) for k in evict], True
+
+    def entries(self):
+        """Return a dict for each entry: its key, size, live references and whether it is complete."""
+        return [{
+            'key': k,
+            'size': self._size(k),
+            'refs': self._live_refs(k),
+            'complete': self._copier(k) is None,
+        } for k in sorted(self._keys())]
+
+    def acquire(self, source, ref, pid, copy=copy_tree):
+        """Return the path of a cached copy of *source*, taking a reference to it for *ref*.
+
+        *pid* is the process of the job holding the reference. If the source
+        is not cached, it is copied with *copy*, given the source, the
+        directory to copy into and the manifest of the source. Other jobs
+        wanting the same source wait for that copy rather than making their
+        own. Returns ``None``, without taking a reference, if there is no
+        room for the copy.
+        """
+        source = os.path.abspath(source)
+        manifest = build_manifest(source)
+        key = cache_key(source, manifest)
+        size = sum(s for _, s, _ in manifest.files)
+        data = self._entry(key, 'data', os.path.basename(source))
+        while True:
+            doomed = []
+            fd = self._lock()
+            try:
+                copier = self._copier(key) if os.path.isdir(self._entry(key)) else 0
+                if copier is None:
+                    self._add_ref(key, ref, pid)
+                    return data
+                if not copier:
+                    # Not cached, or the copy was abandoned part way.
+                    if os.path.isdir(self._entry(key)):
+                        doomed.append(self._remove(key))
+                    evicted, room = self._make_room(size)
+                    doomed.extend(evicted)
+                    if not room:
+                        print('No room in staging cache {} for the {} bytes of {}'.format(
+                            self.directory, size, source), file=sys.stderr)
+                        return None
+                    os.makedirs(self._entry(key, 'data'))
+                    with open(self._entry(key, 'size'), 'w') as f:
+                        f.write(str(size))
+                    with open(self._entry(key, 'copying'), 'w') as f:
+                        f.write(str(os.getpid()))
+                    self._add_ref(key, ref, pid)
+                    break
+            finally:
+                os.close(fd)
+                for path in doomed:
+                    delete(path)
+            time.sleep(POLL_INTERVAL)
+
+        try:
+            copy(source, os.path.dirname(data), manifest)
+        except BaseException:
+            fd = self._lock()
+            try:
+                doomed = self._remove(key)
+            finally:
+                os.close(fd)
+            delete(doomed)
+            raise
+        make_read_only(data)
+        open(self._entry(key, 'complete'), 'w').close()
+        os.remove(self._entry(key, 'copying'))
+        return data
+
+    def release(self, ref, evict=False):
+        """Drop every reference held by *ref*.
+
+        With *evict*, also delete every complete entry that no job refers to.
+        """
+        for key in self._keys():
+            try:
+                os.remove(self._entry(key, 'refs', ref))
+                os.utime(self._entry(key, 'refs'))
+            except FileNotFoundError:
+                pass
+        if evict:
+            fd = self._lock()
+            try:
+                doomed = self._abandoned() + [self._remove(k) for k in self._unused()]
+            finally:
+                os.close(fd)
+            for path in doomed:
+                delete(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Share data staged by mqsub between jobs on a node')
+    subparsers = parser.add_subparsers(dest='action')
+    acquire = subparsers.add_parser('acquire', help='Stage SOURCE if needed, and print the path of the copy')
+    acquire.add_argument('source')
+    release = subparsers.add_parser('release', help='Drop the references of a job')
+    for subparser in (acquire, release):
+        subparser.add_argument('--cache', required=True, help='Cache directory')
+        subparser.add_argument('--ref', required=True, help='Name of the reference, e.g. the job ID')
+    acquire.add_argument('--pid', type=int, required=True, help='Process whose exit ends the reference')
+    release.add_argument('--evict', action='store_true', help='Also delete the copies no job is using')
+    args = parser.parse_args()
+
+    cache = StageCache(args.cache)
+    if args.action == 'acquire':
+        path = cache.acquire(args.source, args.ref, args.pid)
+        if path is None:
+            sys.exit(NO_ROOM)
+        print(path)
+    elif args.action == 'release':
+        cache.release(args.ref, evict=args.evict)
+    else:
+        parser.error('Specify acquire or release')
+
+
+if __name__ == '__main__':
+    main()
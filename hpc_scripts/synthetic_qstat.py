@@ -0,0 +1,136 @@
+"""Synthetic ``qstat -f -F json`` snapshots for benchmarks and tests.
+
+:func:`synthetic_snapshot` builds a cluster-wide snapshot in which user
+``me`` has a given number of jobs among those of 200 other users. The
+cluster runs 10k-200k jobs at a time, so snapshots of that size exercise
+the same code paths as production. :func:`write_replay_dir` writes a
+series of them, one directory per refresh, for ``mqtop --replay``. Between
+refreshes, jobs make progress and some of them finish and move to
+``qstatx.json``, as with the files written by the cron job on the cluster.
+
+    python3 hpc_scripts/synthetic_qstat.py replay/ --snapshots 10 --jobs 1000 --other-jobs 100000
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+
+DAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+def pbs_time(ts):
+    tm = time.localtime(ts)
+    return f"{DAYS[tm.tm_wday]} {MONTHS[tm.tm_mon - 1]} {tm.tm_mday:2d} {tm.tm_hour:02}:{tm.tm_min:02}:{tm.tm_sec:02} {tm.tm_year}"
+
+
+def hms(seconds):
+    return f"{seconds // 3600:02}:{(seconds % 3600) // 60:02}:{seconds % 60:02}"
+
+
+def _job(rng, i, user, now):
+    ncpus = rng.choice([1, 2, 4, 8, 16, 32])
+    walltime = rng.choice([1, 4, 12, 24, 48]) * 3600
+    used = rng.randrange(walltime)
+    qtime = now - used - rng.randrange(24 * 3600)
+    return f"{10000000 + i}.aqua", {
+        "Job_Name": f"job{i}.sh",
+        "Job_Owner": f"{user}@aquarius01",
+        "euser": user,
+        "job_state": rng.choice(["R", "R", "R", "Q"]),
+        "queue": "cpu_batch_exec",
+        "qtime": pbs_time(qtime),
+        "stime": pbs_time(now - used),
+        "mtime": pbs_time(now),
+        "Resource_List": {"ncpus": ncpus, "mem": f"{ncpus * 4}gb", "walltime": hms(walltime)},
+        "resources_used": {
+            "cpupercent": rng.randrange(ncpus * 100),
+            "cput": hms(used * ncpus // 2),
+            "mem": f"{rng.randrange(1, ncpus * 4 * 1024 * 1024)}kb",
+            "ncpus": ncpus,
+            "vmem": f"{rng.randrange(1, ncpus * 4 * 1024 * 1024)}kb",
+            "walltime": hms(used),
+        },
+    }
+
+
+def synthetic_snapshot(num_jobs, other_jobs, seed=0, now=None):
+    """Return a ``qstat -f -F json`` dict with *num_jobs* jobs of user ``me``."""
+    rng = random.Random(seed)
+    now = int(time.time() if now is None else now)
+    jobs = {}
+    for i in range(num_jobs + other_jobs):
+        user = "me" if i < num_jobs else f"user{rng.randrange(200)}"
+        job_id, job = _job(rng, i, user, now)
+        jobs[job_id] = job
+    return {"timestamp": now, "Jobs": jobs}
+
+
+def _advance(rng, job, seconds, now):
+    """Move a running job on by *seconds*. Returns ``False`` once it has finished."""
+    if job["job_state"] == "Q":
+        if rng.random() < 0.1:
+            job["job_state"] = "R"
+            job["stime"] = pbs_time(now)
+        return True
+    walltime = sum(int(p) * m for p, m in zip(job["Resource_List"]["walltime"].split(":"), (3600, 60, 1)))
+    ru = job["resources_used"]
+    used = sum(int(p) * m for p, m in zip(ru["walltime"].split(":"), (3600, 60, 1))) + seconds
+    ncpus = ru["ncpus"]
+    ru["walltime"] = hms(min(used, walltime))
+    ru["cpupercent"] = rng.randrange(ncpus * 100)
+    ru["mem"] = f"{rng.randrange(1, ncpus * 4 * 1024 * 1024)}kb"
+    job["mtime"] = pbs_time(now)
+    return used < walltime and rng.random() > 0.01
+
+
+def write_replay_dir(directory, snapshots, num_jobs, other_jobs, interval=60, seed=0):
+    """Write *snapshots* refreshes of a synthetic cluster under *directory*.
+
+    Each refresh goes in ``<directory>/<n>/`` as ``qstat.json`` and
+    ``qstatx.json``, with modification times *interval* seconds apart.
+    Returns the refresh directories.
+    """
+    rng = random.Random(seed)
+    start = int(time.time()) - snapshots * interval
+    active = synthetic_snapshot(num_jobs, other_jobs, seed=seed, now=start)["Jobs"]
+    finished = {}
+    paths = []
+    for n in range(snapshots):
+        now = start + n * interval
+        if n:
+            for job_id in list(active):
+                job = active[job_id]
+                if not _advance(rng, job, interval, now):
+                    del active[job_id]
+                    job["job_state"] = "F"
+                    job["obittime"] = pbs_time(now)
+                    job["Exit_status"] = rng.choice([0, 0, 0, 1])
+                    finished[job_id] = job
+        path = os.path.join(directory, f"{n:04d}")
+        os.makedirs(path, exist_ok=True)
+        for name, jobs in (("qstat.json", active), ("qstatx.json", finished)):
+            file_path = os.path.join(path, name)
+            with open(file_path, "w") as fh:
+                json.dump({"timestamp": now, "Jobs": jobs}, fh)
+            os.utime(file_path, (now, now))
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic qstat snapshots for mqtop --replay")
+    parser.add_argument("directory", help="Directory to write the snapshots to")
+    parser.add_argument("--snapshots", type=int, default=10, help="Number of refreshes [default: 10]")
+    parser.add_argument("--jobs", type=int, default=1000, help="Jobs of user 'me' [default: 1000]")
+    parser.add_argument("--other-jobs", type=int, default=50000, help="Jobs of other users [default: 50000]")
+    parser.add_argument("--interval", type=int, default=60, help="Seconds between refreshes [default: 60]")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed [default: 0]")
+    args = parser.parse_args()
+    write_replay_dir(args.directory, args.snapshots, args.jobs, args.other_jobs, args.interval, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""On-disk time series of cluster and group utilisation.
+
+:class:`UsageHistory` keeps samples of a few named metrics (percentages such
+as cluster CPU allocation) in an SQLite database. Every sample is also
+folded into 5-minute and hourly buckets holding a count, sum, minimum and
+maximum. Queries read those buckets instead of the raw rows, so a month of
+1-minute samples is answered from a few hundred rows per metric.
+
+Raw samples and each bucket size are pruned after their own retention
+period (see ``RAW_RETENTION`` and ``RESOLUTIONS``), so the database stays
+small when a recorder runs every minute for years.
+
+The database location is read from ``MQSTAT_HISTORY_DB``
+[default: ``~/.local/share/hpc_scripts/mqstat_history.sqlite``].
+"""
+
+import math
+import os
+import sqlite3
+import time
+
+DAY = 24 * 3600
+
+# How long raw samples are kept, in seconds.
+RAW_RETENTION = 2 * DAY
+
+# Bucket size in seconds -> how long buckets of that size are kept.
+RESOLUTIONS = {
+    300: 35 * DAY,
+    3600: 2 * 365 * DAY,
+}
+
+# Named query periods -> (length in seconds, bucket size used to answer them).
+PERIODS = {
+    'day': (DAY, 300),
+    'week': (7 * DAY, 3600),
+    'month': (30 * DAY, 3600),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    ts INTEGER NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts);
+CREATE TABLE IF NOT EXISTS buckets (
+    resolution INTEGER NOT NULL,
+    metric TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    total REAL NOT NULL,
+    lo REAL NOT NULL,
+    hi REAL NOT NULL,
+    PRIMARY KEY (resolution, metric, bucket)
+);
+CREATE INDEX IF NOT EXISTS buckets_age ON buckets (resolution, bucket);
+"""
+
+
+def default_path():
+    return os.environ.get(
+        'MQSTAT_HISTORY_DB',
+        os.path.join(os.path.expanduser('~'), '.local', 'share', 'hpc_scripts', 'mqstat_history.sqlite'))
+
+
+def percentile(values, q):
+    """Return the *q*th percentile (0-100) of *values*, interpolating linearly."""
+    values = sorted(values)
+    if not values:
+        return None
+    pos = (len(values) - 1) * q / 100
+    lower = math.floor(pos)
+    upper = math.ceil(pos)
+    return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
+
+class UsageHistory:
+    def __init__(self, path=None):
+        if path is None:
+            path = default_path()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        # Recorders run from cron, so wait for a concurrent writer rather
+        # than failing.
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def record(self, values, ts=None):
+        """Store one sample of each metric in the *values* dict."""
+        if ts is None:
+            ts = time.time()
+        ts = int(ts)
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO samples (ts, metric, value) VALUES (?, ?, ?)",
+                [(ts, metric, float(value)) for metric, value in values.items()])
+            for resolution in RESOLUTIONS:
+                bucket = ts - ts % resolution
+                for metric, value in values.items():
+                    value = float(value)
+                    # UPDATE-then-INSERT rather than an upsert so older
+                    # SQLite versions on cluster login nodes work too.
+                    cursor = self.db.execute(
+                        "UPDATE buckets SET n = n + 1, total = total + ?, lo = min(lo, ?), hi = max(hi, ?) "
+                        "WHERE resolution = ? AND metric = ? AND bucket = ?",
+                        (value, value, value, resolution, metric, bucket))
+                    if cursor.rowcount == 0:
+                        self.db.execute(
+                            "INSERT INTO buckets (resolution, metric, bucket, n, total, lo, hi) "
+                            "VALUES (?, ?, ?, 1, ?, ?, ?)",
+                            (resolution, metric, bucket, value, value, value))
+            self._prune(ts)
+
+    def _prune(self, now):
+        self.db.execute("DELETE FROM samples WHERE ts < ?", (now - RAW_RETENTION,))
+        for resolution, retention in RESOLUTIONS.items():
+            self.db.execute(
+                "DELETE FROM buckets WHERE resolution = ? AND bucket < ?",
+                (resolution, now - retention))
+
+    def metrics(self):
+        return [row[0] for row in self.db.execute(
+            "SELECT DISTINCT metric FROM buckets WHERE resolution = ?", (min(RESOLUTIONS),))]
+
+    def series(self, metric, start, end=None, resolution=3600):
+        """Return ``(bucket_start, mean, lo, hi)`` tuples for *metric*.
+
+        Covers buckets of *resolution* seconds starting in ``[start, end)``,
+        oldest first. Buckets with no samples are left out.
+        """
+        if end is None:
+            end = time.time()
+        return [
+            (bucket, total / n, lo, hi)
+            for bucket, n, total, lo, hi in self.db.execute(
+                "SELECT bucket, n, total, lo, hi FROM buckets "
+                "WHERE resolution = ? AND metric = ? AND bucket >= ? AND bucket < ? ORDER BY bucket",
+                (resolution, metric, int(start), int(end)))
+        ]
+
+    def latest(self, metric):
+        """Return ``(ts, value)`` of the newest raw sample of *metric*, or ``None``."""
+        return self.db.execute(
+            "SELECT ts, value FROM samples WHERE metric = ? ORDER BY ts DESC LIMIT 1",
+            (metric,)).fetchone()
@@ -1,35 +1,39 @@
 use serde::Serialize;
-use serde_json::{Map, Value};
+use serde_json::{json, Map, Value};
 use simd_json::serde::from_slice;
+use std::collections::BTreeMap;
 use std::env;
-use std::fs::File;
-use std::io::Read;
+use std::fs::{self, File};
+use std::io::{self, BufWriter, Read, Write};
+use std::os::unix::fs::MetadataExt;
+use std::path::{Path, PathBuf};
+use std::time::UNIX_EPOCH;
 
-fn main() -> Result<(), Box<dyn std::error::Error>> {
-    let args: Vec<String> = env::args().collect();
-    if args.len() != 3 {
-        eprintln!("Usage: {} <json_path> <user>", args[0]);
-        std::process::exit(1);
-    }
-    let path = &args[1];
-    let user = &args[2];
+#[derive(Serialize)]
+struct JobWithId<'a> {
+    #[serde(flatten)]
+    job: &'a Map<String, Value>,
+    id: &'a str,
+}
 
+/// Read and parse a qstat JSON snapshot, returning it with the metadata of
+/// the file that was read.
+fn read_snapshot(path: &str) -> Result<(Value, fs::Metadata), Box<dyn std::error::Error>> {
     let mut file = File::open(path)?;
+    let meta = file.metadata()?;
     let mut buf = Vec::new();
     file.read_to_end(&mut buf)?;
     // simd_json requires a mutable slice
     let data: Value = from_slice(&mut buf)?;
+    Ok((data, meta))
+}
 
-    if let Some(jobs) = data.get("Jobs").and_then(|j| j.as_object()) {
-        #[derive(Serialize)]
-        struct JobWithId<'a> {
-            #[serde(flatten)]
-            job: &'a Map<String, Value>,
-            id: &'a str,
-        }
+fn filter(path: &str, user: &str) -> Result<(), Box<dyn std::error::Error>> {
+    let (data, _) = read_snapshot(path)?;
 
+    if let Some(jobs) = data.get("Jobs").and_then(|j| j.as_object()) {
         for (id, job) in jobs {
-            if job.get("euser").and_then(Value::as_str) == Some(user.as_str()) {
+            if job.get("euser").and_then(Value::as_str) == Some(user) {
                 if let Value::Object(map) = job {
                     let out = JobWithId { job: map, id };
                     println!("{}", serde_json::to_string(&out)?);
@@ -41,3 +45,347 @@ fn main() -> Result<(), Box<dyn std::error::Error>> {
     Ok(())
 }
 
+/// Column names of `--compact` output, which follow the header line.
+const COMPACT_COLUMNS: [&str; 20] = [
+    "id",
+    "queue",
+    "state",
+    "name",
+    "user",
+    "qtime",
+    "stime",
+    "obittime",
+    "mtime",
+    "ncpus",
+    "ngpus",
+    "mem_request_bytes",
+    "walltime_total",
+    "cpupercent",
+    "ncpus_used",
+    "mem_kb",
+    "vmem_kb",
+    "walltime_used",
+    "cput",
+    "exit_status",
+];
+
+const MONTHS: [&str; 12] = [
+    "Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec",
+];
+
+/// Days from 1970-01-01 to the given date in the proleptic Gregorian calendar.
+fn days_from_civil(year: i64, month: i64, day: i64) -> i64 {
+    let year = if month <= 2 { year - 1 } else { year };
+    let era = if year >= 0 { year } else { year - 399 } / 400;
+    let year_of_era = year - era * 400;
+    let day_of_year = (153 * ((month + 9) % 12) + 2) / 5 + day - 1;
+    let day_of_era = year_of_era * 365 + year_of_era / 4 - year_of_era / 100 + day_of_year;
+    era * 146097 + day_of_era - 719468
+}
+
+/// Convert a PBS time such as `Mon Jan  1 10:00:00 2024` to seconds since
+/// 1970 on the local wall clock. The reader applies the local UTC offset,
+/// which needs the time zone database.
+fn wall_clock_seconds(val: &str) -> Option<i64> {
+    let parts: Vec<&str> = val.split_whitespace().collect();
+    if parts.len() != 5 {
+        return None;
+    }
+    let month = MONTHS.iter().position(|m| *m == parts[1])? as i64 + 1;
+    let day: i64 = parts[2].parse().ok()?;
+    let year: i64 = parts[4].parse().ok()?;
+    let hms: Vec<i64> = parts[3]
+        .split(':')
+        .map(|p| p.parse().ok())
+        .collect::<Option<_>>()?;
+    if hms.len() != 3 || !(1..=31).contains(&day) || hms[0] > 23 || hms[1] > 59 || hms[2] > 61 {
+        return None;
+    }
+    Some(days_from_civil(year, month, day) * 86400 + hms[0] * 3600 + hms[1] * 60 + hms[2])
+}
+
+/// Seconds in a `[[HH:]MM:]SS` duration; 0 if missing or malformed.
+fn hms_seconds(val: Option<&Value>) -> i64 {
+    let text = match val.and_then(text) {
+        Some(text) if !text.is_empty() => text,
+        _ => return 0,
+    };
+    let parts: Option<Vec<i64>> = text.split(':').map(|p| p.trim().parse().ok()).collect();
+    let mut parts = match parts {
+        Some(parts) => parts,
+        None => return 0,
+    };
+    while parts.len() < 3 {
+        parts.insert(0, 0);
+    }
+    let n = parts.len();
+    parts[n - 3] * 3600 + parts[n - 2] * 60 + parts[n - 1]
+}
+
+/// Split a PBS size such as `8gb` into its number and lower-case unit.
+fn size_parts(val: Option<&Value>) -> Option<(u64, String)> {
+    let text = val.and_then(text)?;
+    let digits = text.len() - text.trim_start_matches(|c: char| c.is_ascii_digit()).len();
+    let unit: String = text[digits..]
+        .chars()
+        .take_while(|c| c.is_ascii_alphabetic())
+        .collect();
+    if digits == 0 || unit.is_empty() {
+        return None;
+    }
+    Some((text[..digits].parse().ok()?, unit.to_ascii_lowercase()))
+}
+
+fn size_bytes(val: Option<&Value>) -> u64 {
+    match size_parts(val) {
+        Some((n, unit)) => match unit.as_str() {
+            "b" => n,
+            "kb" => n.saturating_mul(1 << 10),
+            "mb" => n.saturating_mul(1 << 20),
+            "gb" => n.saturating_mul(1 << 30),
+            _ => 0,
+        },
+        None => 0,
+    }
+}
+
+fn size_kb(val: Option<&Value>) -> u64 {
+    match size_parts(val) {
+        Some((n, unit)) => match unit.as_str() {
+            "b" => n / 1024,
+            "kb" => n,
+            "mb" => n.saturating_mul(1 << 10),
+            "gb" => n.saturating_mul(1 << 20),
+            _ => 0,
+        },
+        None => 0,
+    }
+}
+
+/// A JSON string or number as text.
+fn text(val: &Value) -> Option<String> {
+    match val {
+        Value::String(s) => Some(s.clone()),
+        Value::Number(n) => Some(n.to_string()),
+        _ => None,
+    }
+}
+
+fn integer(val: Option<&Value>) -> Option<i64> {
+    match val? {
+        Value::Number(n) => n.as_i64().or_else(|| n.as_f64().map(|f| f as i64)),
+        Value::String(s) => s.trim().parse().ok(),
+        _ => None,
+    }
+}
+
+/// Escape tabs, newlines and backslashes so a string fits in one TSV cell.
+fn escape(val: &str) -> String {
+    let mut out = String::with_capacity(val.len());
+    for c in val.chars() {
+        match c {
+            '\\' => out.push_str("\\\\"),
+            '\t' => out.push_str("\\t"),
+            '\n' => out.push_str("\\n"),
+            '\r' => out.push_str("\\r"),
+            c => out.push(c),
+        }
+    }
+    out
+}
+
+fn optional<T: ToString>(val: Option<T>) -> String {
+    val.map(|v| v.to_string()).unwrap_or_default()
+}
+
+/// One `--compact` row: the fields mqtop shows, with times, sizes and
+/// durations already converted to integers. Missing values are empty.
+fn compact_row(id: &str, job: &Map<String, Value>) -> String {
+    let empty = Map::new();
+    let resources = job.get("Resource_List").and_then(Value::as_object).unwrap_or(&empty);
+    let used = job.get("resources_used").and_then(Value::as_object).unwrap_or(&empty);
+    let string = |key: &str| job.get(key).and_then(text).map(|s| escape(&s)).unwrap_or_default();
+    let time = |key: &str| optional(job.get(key).and_then(text).and_then(|t| wall_clock_seconds(&t)));
+    let user = match job.get("euser").and_then(text).filter(|s| !s.is_empty()) {
+        Some(user) => user,
+        None => job
+            .get("Job_Owner")
+            .and_then(text)
+            .map(|owner| owner.split('@').next().unwrap_or("").to_string())
+            .unwrap_or_default(),
+    };
+    let walltime_total = match resources.get("walltime").and_then(text) {
+        Some(walltime) if !walltime.is_empty() => hms_seconds(resources.get("walltime")).to_string(),
+        _ => String::new(),
+    };
+    let exit_status = if job.contains_key("Exit_status") {
+        optional(integer(job.get("Exit_status")))
+    } else {
+        String::new()
+    };
+    [
+        escape(id),
+        string("queue"),
+        string("job_state"),
+        string("Job_Name"),
+        escape(&user),
+        time("qtime"),
+        time("stime"),
+        time("obittime"),
+        time("mtime"),
+        integer(resources.get("ncpus")).unwrap_or(0).to_string(),
+        integer(resources.get("ngpus")).unwrap_or(0).to_string(),
+        size_bytes(resources.get("mem")).to_string(),
+        walltime_total,
+        integer(used.get("cpupercent")).unwrap_or(0).to_string(),
+        integer(used.get("ncpus")).unwrap_or(0).to_string(),
+        size_kb(used.get("mem")).to_string(),
+        size_kb(used.get("vmem")).to_string(),
+        hms_seconds(used.get("walltime")).to_string(),
+        hms_seconds(used.get("cput")).to_string(),
+        exit_status,
+    ]
+    .join("\t")
+}
+
+/// Like `filter`, but print a header line and then one `compact_row` per job.
+fn compact(path: &str, user: &str) -> Result<(), Box<dyn std::error::Error>> {
+    let (data, _) = read_snapshot(path)?;
+    let stdout = io::stdout();
+    let mut out = BufWriter::new(stdout.lock());
+    writeln!(out, "#qstat_filter compact 1\t{}", COMPACT_COLUMNS.join("\t"))?;
+
+    if let Some(jobs) = data.get("Jobs").and_then(|j| j.as_object()) {
+        for (id, job) in jobs {
+            if job.get("euser").and_then(Value::as_str) == Some(user) {
+                if let Value::Object(map) = job {
+                    writeln!(out, "{}", compact_row(id, map))?;
+                }
+            }
+        }
+    }
+
+    out.flush()?;
+    Ok(())
+}
+
+/// Name of the shard file for *user*. Names that are unsafe as file names
+/// fall back to the user's position in the index.
+fn shard_file_name(user: &str, position: usize) -> String {
+    let safe = !user.is_empty()
+        && !user.starts_with('.')
+        && user
+            .chars()
+            .all(|c| c.is_ascii_alphanumeric() || c == '_' || c == '-' || c == '.');
+    if safe {
+        format!("{}.ndjson", user)
+    } else {
+        format!("user-{}.ndjson", position)
+    }
+}
+
+/// Write the jobs of each user in the snapshot at *path* to their own NDJSON
+/// file, and an index describing them.
+///
+/// Shards go in a new directory under `<path>.shards/`. The index is written
+/// to `<path>.shards.json` last, by renaming a temporary file over it, so
+/// readers see either the old shards or the new ones. The index records the
+/// inode, size and mtime of the snapshot it was built from, so readers can
+/// tell when it is stale. Only the previous set of shards is kept, for
+/// readers that loaded the old index just before it was replaced.
+fn shard(path: &str) -> Result<(), Box<dyn std::error::Error>> {
+    let (data, meta) = read_snapshot(path)?;
+    let mtime_ns = meta.modified()?.duration_since(UNIX_EPOCH)?.as_nanos() as u64;
+
+    let mut lines: BTreeMap<&str, Vec<u8>> = BTreeMap::new();
+    let mut states: BTreeMap<&str, BTreeMap<&str, u64>> = BTreeMap::new();
+    let mut counts: BTreeMap<&str, u64> = BTreeMap::new();
+    if let Some(jobs) = data.get("Jobs").and_then(|j| j.as_object()) {
+        for (id, job) in jobs {
+            let user = match job.get("euser").and_then(Value::as_str) {
+                Some(user) => user,
+                None => continue,
+            };
+            if let Value::Object(map) = job {
+                let out = lines.entry(user).or_default();
+                serde_json::to_writer(&mut *out, &JobWithId { job: map, id })?;
+                out.push(b'\n');
+                *counts.entry(user).or_default() += 1;
+                let state = map.get("job_state").and_then(Value::as_str).unwrap_or("?");
+                *states.entry(user).or_default().entry(state).or_default() += 1;
+            }
+        }
+    }
+
+    let index_path = PathBuf::from(format!("{}.shards.json", path));
+    let shards_root = PathBuf::from(format!("{}.shards", path));
+    let shards_name = shards_root
+        .file_name()
+        .ok_or("snapshot path has no file name")?
+        .to_string_lossy()
+        .into_owned();
+    let generation = format!("{}-{}", mtime_ns, std::process::id());
+    let generation_dir = shards_root.join(&generation);
+    fs::create_dir_all(&generation_dir)?;
+
+    let mut users = Map::new();
+    for (position, (user, out)) in lines.iter().enumerate() {
+        let file_name = shard_file_name(user, position);
+        File::create(generation_dir.join(&file_name))?.write_all(out)?;
+        users.insert(
+            user.to_string(),
+            json!({
+                "file": file_name,
+                "bytes": out.len(),
+                "jobs": counts[user],
+                "states": states[user],
+            }),
+        );
+    }
+
+    let previous = previous_generation(&index_path);
+    let index = json!({
+        "version": 1,
+        "source": {"inode": meta.ino(), "size": meta.len(), "mtime_ns": mtime_ns},
+        "dir": format!("{}/{}", shards_name, generation),
+        "users": users,
+    });
+    let tmp_path = PathBuf::from(format!("{}.{}.tmp", index_path.display(), std::process::id()));
+    fs::write(&tmp_path, serde_json::to_vec(&index)?)?;
+    fs::rename(&tmp_path, &index_path)?;
+
+    for entry in fs::read_dir(&shards_root)? {
+        let entry = entry?;
+        let name = entry.file_name().to_string_lossy().into_owned();
+        if name != generation && Some(&name) != previous.as_ref() {
+            let _ = fs::remove_dir_all(entry.path());
+        }
+    }
+
+    Ok(())
+}
+
+/// The shard directory named by the current index at *index_path*, if any.
+fn previous_generation(index_path: &Path) -> Option<String> {
+    let text = fs::read_to_string(index_path).ok()?;
+    let index: Value = serde_json::from_str(&text).ok()?;
+    let dir = index.get("dir")?.as_str()?;
+    Some(dir.rsplit('/').next()?.to_string())
+}
+
+fn main() -> Result<(), Box<dyn std::error::Error>> {
+    let args: Vec<String> = env::args().collect();
+    if args.len() == 3 && args[1] == "--shard" {
+        return shard(&args[2]);
+    }
+    if args.len() == 4 && args[1] == "--compact" {
+        return compact(&args[2], &args[3]);
+    }
+    if args.len() != 3 {
+        eprintln!("Usage: {} <json_path> <user>", args[0]);
+        eprintln!("       {} --compact <json_path> <user>", args[0]);
+        eprintln!("       {} --shard <json_path>", args[0]);
+        std::process::exit(1);
+    }
+    filter(&args[1], &args[2])
+}
@@ -0,0 +1,38 @@
+import subprocess
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from hpc_scripts.command_ledger import command_hash, ledger_dir, mean_seconds, read_ledger, succeeded
+
+
+def test_command_hash_matches_sha1sum():
+    command = "echo 'héllo'\t$HOME | wc -c"
+    result = subprocess.run(["bash", "-c", 'printf "%s" "$1" | sha1sum', "_", command],
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.split()[0] == command_hash(command)
+
+
+def test_read_ledger_merges_shards_and_skips_partial_lines(tmp_path):
+    directory = Path(ledger_dir(str(tmp_path / "cmds.txt")))
+    assert directory == tmp_path / "cmds.txt.ledger"
+    assert read_ledger(str(directory)) == []
+    directory.mkdir()
+    (directory / "1.aqua.0.tsv").write_text("aaa\t0\t5\t1700000000\t1.aqua\nbbb\t1\t2\t1700000001\t1.aqua\n")
+    # A job killed part way through writing a line.
+    (directory / "2.aqua.1.tsv").write_text("bbb\t0\t3\t1700000100\t2.aqua\nccc\t0\t")
+    records = read_ledger(str(directory))
+    assert [(r["hash"], r["status"], r["job_id"]) for r in records] == [
+        ("aaa", 0, "1.aqua"), ("bbb", 1, "1.aqua"), ("bbb", 0, "2.aqua")]
+    assert succeeded(records) == {"aaa", "bbb"}
+
+
+def test_mean_seconds_prefers_successful_runs():
+    records = [
+        {"hash": "a", "status": 0, "seconds": 10},
+        {"hash": "a", "status": 1, "seconds": 1},
+        {"hash": "a", "status": 0, "seconds": 20},
+        {"hash": "b", "status": 2, "seconds": 4},
+    ]
+    assert mean_seconds(records) == {"a": 15, "b": 4}
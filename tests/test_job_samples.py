@@ -0,0 +1,43 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from hpc_scripts.job_samples import JobSamples, SampleRing, sparkline
+
+
+def test_sample_ring_keeps_last_samples_in_order():
+    ring = SampleRing(capacity=3)
+    assert len(ring) == 0 and ring.last("mem_kb") is None
+    for i in range(5):
+        ring.add(100 + i, i * 10, [5, 50, 7, 6, 8][i], 0, i * 60)
+    assert len(ring) == 3
+    assert ring.series("time") == [102, 103, 104]
+    assert ring.series("cpupercent") == [20, 30, 40]
+    assert ring.last("walltime_used") == 240
+    # The peak includes samples that have dropped out of the ring.
+    assert ring.peak_mem_kb == 50
+    assert len(ring._values) == 3 * 5
+
+
+def test_job_samples_records_running_jobs_once_per_snapshot():
+    samples = JobSamples(capacity=4)
+    jobs = [
+        {"id": "1.s", "state": "R", "cpupercent": 100, "mem_usage": 10, "walltime_used": 60},
+        {"id": "2.s", "state": "Q"},
+    ]
+    samples.record(jobs, now=1000)
+    samples.record(jobs, now=1030)
+    assert len(samples) == 1 and samples.revision == 1
+    samples.record([dict(jobs[0], walltime_used=120, mem_usage=30)], now=1060)
+    ring = samples.get("1.s")
+    assert ring.series("mem_kb") == [10, 30] and samples.revision == 2
+    samples.prune({"2.s"})
+    assert samples.get("1.s") is None and len(samples) == 0
+
+
+def test_sparkline_averages_into_columns():
+    assert sparkline([], 5) == ""
+    assert sparkline([0, 100], 5) == "▁█"
+    assert sparkline([0, 0, 100, 100, 50, 50], 3) == "▁█▅"
+    assert sparkline([-5, 250], 2) == "▁█"
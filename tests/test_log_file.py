@@ -0,0 +1,91 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from hpc_scripts.log_file import MAX_LINE, LogFile, display_text
+
+
+def _walk(log, count):
+    """Read *count* lines forwards from the start one at a time."""
+    offsets = [0]
+    while len(offsets) < count:
+        offsets.append(log.next_line(offsets[-1]))
+    return offsets
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1 << 16])
+@pytest.mark.parametrize("ending", ["\n", ""])
+def test_lines_forwards_and_backwards(tmp_path, chunk_size, ending):
+    text = "\n".join(f"line {i}" + "x" * (i % 7) for i in range(50)) + ending
+    path = tmp_path / "job.OU"
+    path.write_text(text)
+    log = LogFile(path, chunk_size=chunk_size)
+    expected = text.rstrip("\n").split("\n")
+    starts = [0]
+    for line in expected[:-1]:
+        starts.append(starts[-1] + len(line) + 1)
+
+    assert log.lines(0, 100) == [(s, l.encode()) for s, l in zip(starts, expected)]
+    assert log.lines(starts[10], 2) == [(starts[10], expected[10].encode()), (starts[11], expected[11].encode())]
+    assert _walk(log, 50) == starts
+    assert log.next_line(starts[-1]) is None
+    assert log.previous_line(starts[20]) == starts[19]
+    assert log.previous_line(0) is None
+    assert log.line_start(starts[30] + 3) == starts[30]
+    assert log.tail(5) == starts[-5]
+    assert log.tail(500) == 0
+    log.close()
+
+
+def test_follows_appended_output(tmp_path):
+    path = tmp_path / "job.OU"
+    path.write_text("one\ntwo")
+    log = LogFile(path)
+    assert [line for _, line in log.lines(0, 10)] == [b"one", b"two"]
+    assert log.refresh() is False
+    with open(path, "a") as fh:
+        fh.write(" more\nthree\n")
+    assert log.refresh() is True
+    assert log.tail(2) == 4
+    assert [line for _, line in log.lines(4, 10)] == [b"two more", b"three"]
+    log.close()
+
+
+def test_long_lines_are_split(tmp_path):
+    path = tmp_path / "job.OU"
+    path.write_bytes(b"a" * (MAX_LINE * 2 + 5) + b"\nend\n")
+    log = LogFile(path, chunk_size=4096)
+    assert [(s, len(l)) for s, l in log.lines(0, 10)] == [
+        (0, MAX_LINE), (MAX_LINE, MAX_LINE), (2 * MAX_LINE, 5), (2 * MAX_LINE + 6, 3)
+    ]
+    # Finding a line start never reads back further than one long line.
+    assert log.line_start(2 * MAX_LINE + 4) == MAX_LINE + 4
+    log.close()
+
+
+@pytest.mark.parametrize("chunk_size", [2, 5, 1 << 16])
+def test_find_scans_in_chunks(tmp_path, chunk_size):
+    text = b"alpha\nneedle one\nbeta\nNeedle two\ngamma\n"
+    path = tmp_path / "job.ER"
+    path.write_bytes(text)
+    log = LogFile(path, chunk_size=chunk_size)
+    first = text.index(b"needle")
+    second = text.index(b"Needle")
+
+    assert log.find(b"needle", 0) == first
+    assert log.find(b"needle", first + 1) is None
+    assert log.find(b"needle", first + 1, ignore_case=True) == second
+    assert log.find(b"needle", len(text), backwards=True) == first
+    assert log.find(b"needle", len(text), backwards=True, ignore_case=True) == second
+    assert log.find(b"needle", second, backwards=True, ignore_case=True) == first
+    assert log.find(b"needle", first, backwards=True) is None
+    assert log.find(b"missing", 0) is None
+    log.close()
+
+
+def test_display_text_replaces_control_characters():
+    assert display_text(b"a\tb\x1b[31mred\r") == "a       b?[31mred"
+    assert display_text("caf\xe9".encode() + b"\xff") == "caf\xe9�"
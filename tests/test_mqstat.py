@@ -1,8 +1,13 @@
+import os
 import subprocess
 import sys
 import re
+import time
 from pathlib import Path
 
+# Always query the (fake) PBS commands directly rather than a shared snapshot.
+os.environ["HPC_SCRIPTS_SNAPSHOT_TTL"] = "0"
+
 ANSI = re.compile(r"\x1b\[[0-9;]*m")
 
 def split_cols(line):
@@ -107,6 +112,49 @@ def test_parse_qstat_finished_usage():
     assert finished['obittime'] - finished['start_time'] == 10 * 60
 
 
+def test_parse_qstat_f_fields():
+    repo = Path(__file__).resolve().parents[1]
+    script = repo / "bin" / "mqstat"
+    hist_file = repo / "tests" / "data" / "qstat_xf_finished.txt"
+    import runpy
+    from datetime import datetime
+    mod = runpy.run_path(str(script))
+    with open(hist_file) as f:
+        [job] = mod['parse_qstat_f'](f)
+    assert job['id'] == '10592488.aqua'
+    assert job['name'] == 'snakejobsemibin.23.sh'
+    assert job['user'] == 'woodcrob'
+    assert job['queue'] == 'cpu_batch_exec'
+    assert job['state'] == 'F'
+    assert job['ncpus'] == 24
+    assert job['ngpus'] == 0
+    assert job['ncpus_used'] == 24
+    assert job['cpupercent'] == 2400
+    assert job['mem_usage'] == 26482476
+    assert job['vmem_used_kb'] == 137190880
+    assert job['mem_request_gb'] == 128
+    assert job['walltime_used'] == 20 * 3600 + 28 * 60 + 57
+    assert job['walltime_total'] == 24 * 3600
+    assert job['walltime'] == 24 * 3600 - job['walltime_used']
+    assert job['cpu_usage_remaining'] == 24 * job['walltime']
+    assert job['gpu_usage_remaining'] == 0
+    assert job['cput_used'] == 415 * 3600 + 39 * 60 + 1
+    assert job['exit_status'] == 0
+    expected = datetime.strptime("Fri Aug 22 20:30:34 2025", "%a %b %d %H:%M:%S %Y")
+    assert job['qtime'] == int(expected.timestamp())
+
+
+def test_parse_qstat_f_unknown_memory_unit():
+    repo = Path(__file__).resolve().parents[1]
+    script = repo / "bin" / "mqstat"
+    import runpy
+    import pytest
+    mod = runpy.run_path(str(script))
+    lines = ["Job Id: 1.server\n", "    resources_used.mem = 12mb\n"]
+    with pytest.raises(Exception, match="Unknown memory unit"):
+        mod['parse_qstat_f'](lines)
+
+
 def test_parse_qstat_max_jobs():
     repo = Path(__file__).resolve().parents[1]
     script = repo / "bin" / "mqstat"
@@ -115,16 +163,135 @@ def test_parse_qstat_max_jobs():
     mod = runpy.run_path(str(script))
     captured = []
 
-    def fake_run_command(cmd):
+    def fake_stream_command(cmd, timeout=None):
         captured.append(cmd)
-        return "Job Id: 1.server\n"
+        yield "Job Id: 1.server\n"
 
-    mod['parse_qstat'].__globals__['run_command'] = fake_run_command
+    mod['parse_qstat'].__globals__['stream_command'] = fake_stream_command
     mod['parse_qstat'](max_jobs=10, include_history=True)
-    assert captured == [
-        "qstat -f -t | awk '/Job Id:/{if (count++==10) {print \"AWK_LIMIT_REACHED\"; exit}} {print}'",
-        "qstat -xf -t | awk '/Job Id:/{if (count++==10) {print \"AWK_LIMIT_REACHED\"; exit}} {print}'",
-    ]
+    assert captured == ["qstat -f -t", "qstat -xf -t"]
+    assert mod['parse_qstat'].limit_hit is False
+    assert mod['parse_qstat'].hist_limit_hit is False
+
+
+def test_parse_qstat_max_jobs_stops_reading():
+    repo = Path(__file__).resolve().parents[1]
+    script = repo / "bin" / "mqstat"
+    import os, runpy
+    os.environ.pop("MQSTAT_QSTAT_F", None)
+    mod = runpy.run_path(str(script))
+    state = {'read': 0, 'closed': False}
+
+    def fake_stream_command(cmd, timeout=None):
+        try:
+            for i in range(1, 1000):
+                state['read'] += 1
+                yield f"Job Id: {i}.server\n"
+                yield "    job_state = R\n"
+        finally:
+            state['closed'] = True
+
+    mod['parse_qstat'].__globals__['stream_command'] = fake_stream_command
+    jobs = mod['parse_qstat'](max_jobs=2)
+    assert [j['id'] for j in jobs] == ['1.server', '2.server']
+    assert all(j['state'] == 'R' for j in jobs)
+    assert mod['parse_qstat'].limit_hit is True
+    assert state['read'] == 3
+    assert state['closed'] is True
+
+
+def test_stream_command_terminates_on_close():
+    repo = Path(__file__).resolve().parents[1]
+    script = repo / "bin" / "mqstat"
+    import runpy
+    mod = runpy.run_path(str(script))
+    lines = mod['stream_command'](f"{sys.executable} -c 'while True: print(1, flush=True)'")
+    assert next(lines) == "1\n"
+    lines.close()
+
+
+def test_stream_command_with_a_lot_of_stderr():
+    repo = Path(__file__).resolve().parents[1]
+    import runpy
+    mod = runpy.run_path(str(repo / "bin" / "mqstat"))
+    # Far more stderr than a pipe holds, written before any stdout.
+    command = f"{sys.executable} -c 'import sys; sys.stderr.write(\"x\" * 1000000); print(1)'"
+    assert list(mod['stream_command'](command, timeout=20, quiet=True)) == ["1\n"]
+
+
+def test_stream_command_quiet_failure(capsys):
+    repo = Path(__file__).resolve().parents[1]
+    import runpy
+    mod = runpy.run_path(str(repo / "bin" / "mqstat"))
+    command = f"{sys.executable} -c 'import sys; print(1); sys.exit(35)'"
+    assert list(mod['stream_command'](command, quiet=True)) == ["1\n"]
+    assert list(mod['stream_command']("no_such_command_for_mqstat", quiet=True)) == []
+    assert capsys.readouterr().out == ""
+    assert list(mod['stream_command'](command)) == ["1\n"]
+    assert "Error executing command" in capsys.readouterr().out
+
+
+def test_parse_qstat_json_matches_qstat_f():
+    repo = Path(__file__).resolve().parents[1]
+    import json, runpy
+    mod = runpy.run_path(str(repo / "bin" / "mqstat"))
+    with open(repo / "tests" / "data" / "qstatx_finished.json") as f:
+        data = json.load(f)
+    from_json = mod['parse_qstat_json'](data['Jobs'].items())
+    from_text = mod['parse_qstat'](path=str(repo / "tests" / "data" / "qstat_xf_finished.txt"))
+    # The two fixtures differ only in the recorded job owner.
+    for job in from_json + from_text:
+        job.pop('user')
+    assert from_json == from_text
+
+
+def test_parse_qstat_uses_fresh_snapshot(tmp_path):
+    repo = Path(__file__).resolve().parents[1]
+    import runpy, shutil
+    os.environ.pop("MQSTAT_QSTAT_F", None)
+    mod = runpy.run_path(str(repo / "bin" / "mqstat"))
+    snapshot = mod['PbsSnapshot'](directory=str(tmp_path), ttl=60)
+    shutil.copy(repo / "tests" / "data" / "qstat.json", snapshot.path('qstat'))
+
+    def fake_stream_command(cmd, timeout=None):
+        raise AssertionError("queried PBS despite a fresh snapshot")
+        yield
+
+    mod['parse_qstat'].__globals__['snapshot'] = snapshot
+    mod['parse_qstat'].__globals__['stream_command'] = fake_stream_command
+    jobs = mod['parse_qstat']()
+    assert len(jobs) == 6
+    assert {j['user'] for j in jobs} == {'root'}
+
+
+def test_parse_qstat_snapshot_refresh_and_job_limit(tmp_path, monkeypatch):
+    repo = Path(__file__).resolve().parents[1]
+    import runpy, shutil
+    from hpc_scripts import pbs_snapshot
+    os.environ.pop("MQSTAT_QSTAT_F", None)
+    mod = runpy.run_path(str(repo / "bin" / "mqstat"))
+    snapshot = mod['PbsSnapshot'](directory=str(tmp_path), ttl=60)
+    shutil.copy(repo / "tests" / "data" / "qstat.json", snapshot.path('qstat'))
+    calls = []
+
+    def fake_stream_command(cmd, timeout=None):
+        calls.append(cmd)
+        yield from "Job Id: 1.server\nJob Id: 2.server\n".splitlines(True)
+
+    mod['parse_qstat'].__globals__['snapshot'] = snapshot
+    mod['parse_qstat'].__globals__['stream_command'] = fake_stream_command
+    # With a job limit, qstat is queried so that it can stop early.
+    assert len(mod['parse_qstat'](max_jobs=1)) == 1
+    assert calls == ["qstat -f -t"]
+
+    # A stale snapshot is refreshed, for later callers to share.
+    monkeypatch.setitem(pbs_snapshot.SNAPSHOT_COMMANDS, 'qstat',
+                        "cat {}".format(repo / "tests" / "data" / "qstat.json"))
+    old = time.time() - 120
+    os.utime(snapshot.path('qstat'), (old, old))
+    assert len(mod['parse_qstat']()) == 6
+    assert calls == ["qstat -f -t"]
+    assert snapshot.is_fresh('qstat')
 
 
 def test_parse_qstat_merges_active_and_history():
@@ -134,16 +301,18 @@ def test_parse_qstat_merges_active_and_history():
     os.environ.pop("MQSTAT_QSTAT_F", None)
     mod = runpy.run_path(str(script))
 
-    def fake_run_command(cmd):
-        if "qstat -f -t" in cmd:
-            return "Job Id: 1.server\nJob Id: 2.server\nAWK_LIMIT_REACHED\n"
-        return "Job Id: 2.server\nJob Id: 3.server\n"
+    def fake_stream_command(cmd, timeout=None):
+        if cmd == "qstat -f -t":
+            yield from "Job Id: 1.server\nJob Id: 2.server\nJob Id: 4.server\n".splitlines(True)
+        else:
+            yield from "Job Id: 2.server\nJob Id: 3.server\n".splitlines(True)
 
-    mod['parse_qstat'].__globals__['run_command'] = fake_run_command
-    jobs = mod['parse_qstat'](max_jobs=10, include_history=True)
+    mod['parse_qstat'].__globals__['stream_command'] = fake_stream_command
+    jobs = mod['parse_qstat'](max_jobs=2, include_history=True)
     ids = sorted(j['id'] for j in jobs)
     assert ids == ['1.server', '2.server', '3.server']
     assert mod['parse_qstat'].limit_hit is True
+    assert mod['parse_qstat'].hist_limit_hit is False
 
 
 def test_parse_qstat_history_limit_hit():
@@ -153,13 +322,13 @@ def test_parse_qstat_history_limit_hit():
     os.environ.pop("MQSTAT_QSTAT_F", None)
     mod = runpy.run_path(str(script))
 
-    def fake_run_command(cmd):
-        if "qstat -xf -t" in cmd:
-            return "Job Id: 1.server\nAWK_LIMIT_REACHED\n"
-        return ""
+    def fake_stream_command(cmd, timeout=None):
+        if cmd == "qstat -xf -t":
+            yield from "Job Id: 1.server\nJob Id: 2.server\n".splitlines(True)
 
-    mod['parse_qstat'].__globals__['run_command'] = fake_run_command
-    mod['parse_qstat'](max_jobs=10, include_history=True)
+    mod['parse_qstat'].__globals__['stream_command'] = fake_stream_command
+    mod['parse_qstat'](max_jobs=1, include_history=True)
+    assert mod['parse_qstat'].limit_hit is False
     assert mod['parse_qstat'].hist_limit_hit is True
 
 
@@ -172,12 +341,11 @@ def test_parse_qstat_history_only_when_no_active_jobs():
 
     hist_data = hist_file.read_text()
 
-    def fake_run_command(cmd):
-        if "qstat -f -t" in cmd:
-            return ""
-        return hist_data
+    def fake_stream_command(cmd, timeout=None):
+        if cmd == "qstat -xf -t":
+            yield from hist_data.splitlines(True)
 
-    mod['parse_qstat'].__globals__['run_command'] = fake_run_command
+    mod['parse_qstat'].__globals__['stream_command'] = fake_stream_command
     jobs = mod['parse_qstat'](include_history=True)
     assert [j['id'] for j in jobs] == ['10592488.aqua']
     assert jobs[0]['state'] == 'F'
@@ -395,3 +563,399 @@ def test_watch_jobs_no_curses_error(monkeypatch):
     monkeypatch.setattr(curses, 'wrapper', fake_wrapper)
 
     mod['watch_jobs'](fake_get_jobs, interval=0)
+
+
+def test_watch_jobs_fetches_only_departed_jobs(monkeypatch):
+    repo = Path(__file__).resolve().parents[1]
+    script = repo / "bin" / "mqstat"
+    import runpy, curses, time
+    mod = runpy.run_path(str(script))
+    jobs = {j['id']: j for j in mod['parse_qstat'](path=str(repo / "tests" / "data" / "qstat_f.txt"))}
+    running = [jobs['123.server'], jobs['456.server']]
+    done = dict(jobs['456.server'], state='F', obittime=int(time.time()))
+
+    polls = []
+    responses = [running, running, running[:1], running[:1]]
+
+    def fake_get_jobs(include_history=True):
+        polls.append(include_history)
+        return responses[len(polls) - 1]
+
+    fetched = []
+
+    def fake_get_finished(job_ids):
+        fetched.append(list(job_ids))
+        return [done]
+
+    class DummyScreen:
+        def __init__(self):
+            self.calls = 0
+            self.refreshes = 0
+            self.text = []
+
+        def nodelay(self, flag):
+            pass
+
+        def getch(self):
+            self.calls += 1
+            return -1 if self.calls < 4 else ord('q')
+
+        def getmaxyx(self):
+            return (24, 120)
+
+        def addstr(self, y, x, text, *args):
+            self.text.append(text)
+
+        def erase(self):
+            self.text = []
+
+        def refresh(self):
+            self.refreshes += 1
+
+    monkeypatch.setattr(curses, 'curs_set', lambda n: None)
+    monkeypatch.setattr(curses, 'start_color', lambda: None)
+    monkeypatch.setattr(curses, 'use_default_colors', lambda: None)
+    monkeypatch.setattr(curses, 'init_pair', lambda *a, **k: None)
+    monkeypatch.setattr(curses, 'color_pair', lambda n: 0)
+    monkeypatch.setattr(time, 'sleep', lambda x: None)
+
+    screen = DummyScreen()
+    monkeypatch.setattr(curses, 'wrapper', lambda func: func(screen))
+
+    mod['watch_jobs'](fake_get_jobs, interval=0, refresh_interval=0, get_finished=fake_get_finished)
+
+    # History is read once; afterwards only the job that left is looked up.
+    assert polls == [True, False, False, False]
+    assert fetched == [['456.server']]
+    # The last poll changed nothing, so the screen was not redrawn.
+    assert screen.refreshes == 2
+    finished_rows = screen.text[screen.text.index("Finished jobs ===="):]
+    assert any('456' in t for t in finished_rows)
+
+
+def test_fetch_jobs_queries_only_given_ids():
+    repo = Path(__file__).resolve().parents[1]
+    import runpy
+    mod = runpy.run_path(str(repo / "bin" / "mqstat"))
+    commands = []
+
+    def fake_stream_command(cmd, timeout=None, quiet=False):
+        assert quiet
+        commands.append(cmd)
+        for jid in cmd.split()[3:]:
+            yield f"Job Id: {jid}\n"
+            yield "    job_state = F\n"
+
+    mod['fetch_jobs'].__globals__['stream_command'] = fake_stream_command
+    mod['fetch_jobs'].__globals__['FETCH_JOBS_CHUNK'] = 2
+    jobs = mod['fetch_jobs'](['1.server', '2.server', '3.server'])
+    assert commands == ["qstat -xf -t 1.server 2.server", "qstat -xf -t 3.server"]
+    assert [(j['id'], j['state']) for j in jobs] == [('1.server', 'F'), ('2.server', 'F'), ('3.server', 'F')]
+
+
+def test_collect_sources_concurrent_with_timeout():
+    repo = Path(__file__).resolve().parents[1]
+    script = repo / "bin" / "mqstat"
+    import runpy, time
+
+    mod = runpy.run_path(str(script))
+
+    def slow(value, delay):
+        def fetch():
+            time.sleep(delay)
+            return value
+        return fetch
+
+    def broken():
+        raise Exception("Failed to run qusers")
+
+    start = time.monotonic()
+    results, errors, timings = mod['collect_sources'](
+        {'a': slow(1, 0.3), 'b': slow(2, 0.3), 'c': broken, 'd': slow(3, 5)},
+        {'d': 0.2},
+    )
+    assert time.monotonic() - start < 1
+    assert results == {'a': 1, 'b': 2}
+    assert errors['c'] == "Failed to run qusers"
+    assert errors['d'].startswith("timed out")
+    assert set(timings) == {'a', 'b', 'c', 'd'}
+
+
+def test_dashboard_partial_when_source_fails(monkeypatch, capsys):
+    repo = Path(__file__).resolve().parents[1]
+    script = repo / "bin" / "mqstat"
+    import runpy
+
+    mod = runpy.run_path(str(script))
+    g = mod['main'].__globals__
+
+    def failing_pbsnodes(timeout=None):
+        raise Exception("Failed to run pbsnodes -a")
+
+    g['parse_pbsnodes_output'] = failing_pbsnodes
+    g['parse_qusers_output'] = lambda timeout=None: {
+        'alice': {'cpus_running': 4, 'cpus_queued': 4, 'gpus_running': 0, 'gpus_queued': 0},
+    }
+    g['parse_qstat'] = lambda path=None, timeout=None: []
+    g['get_unix_group_members'] = lambda name: ['alice']
+    monkeypatch.setattr(sys, 'argv', ['mqstat', '--timings'])
+    mod['main']()
+    out = ANSI.sub('', capsys.readouterr().out)
+    assert "WARNING: pbsnodes unavailable (Failed to run pbsnodes -a)" in out
+    assert "No batch jobs found." in out
+    assert "Requested CPUs: 8 (50.0% running)" in out
+    assert "Failed to gather node information" in out
+    assert "=== TIMINGS ===" in out
+    assert "pbsnodes" in out.split("=== TIMINGS ===")[1]
+
+
+def test_record_usage_and_history(tmp_path, capsys):
+    repo = Path(__file__).resolve().parents[1]
+    import runpy, time
+    mod = runpy.run_path(str(repo / "bin" / "mqstat"))
+    g = mod['main'].__globals__
+    nodes = [
+        {'total_cpu': 100, 'used_cpu': 50, 'cpu_usage': 50, 'total_mem': 100, 'used_mem': 25,
+         'ram_usage': 25, 'total_gpu': 0, 'used_gpu': 0, 'gpu_usage': 0},
+    ]
+    g['parse_pbsnodes_output'] = lambda timeout=None: nodes
+    g['parse_qusers_output'] = lambda timeout=None: {
+        'alice': {'cpus_running': 10, 'cpus_queued': 5, 'gpus_running': 0, 'gpus_queued': 0},
+        'bob': {'cpus_running': 40, 'cpus_queued': 0, 'gpus_running': 0, 'gpus_queued': 0},
+    }
+    g['get_unix_group_members'] = lambda name: ['alice', 'thomsonv']
+
+    history = mod['UsageHistory'](str(tmp_path / "history.sqlite"))
+    sample, errors = mod['record_usage'](history, mod['SOURCE_TIMEOUTS'])
+    assert errors == {}
+    assert sample == {'cluster_cpu': 50.0, 'cluster_ram': 25.0, 'cluster_gpu': 0,
+                      'cmr_cpu': 10.0, 'cmr_gpu': 0}
+
+    mod['print_history'](history, 'day', now=time.time() + 60)
+    out = ANSI.sub('', capsys.readouterr().out)
+    rows = {split_cols(line)[0]: split_cols(line)[1:] for line in out.splitlines()[2:]}
+    assert rows['Cluster CPU'][-4:] == ['50.0%', '50.0%', '50.0%', '50.0%']
+    assert rows['CMR CPU'][-4:] == ['10.0%', '10.0%', '10.0%', '10.0%']
+
+
+def test_history_cli_empty_database(tmp_path):
+    repo = Path(__file__).resolve().parents[1]
+    db = tmp_path / "history.sqlite"
+    result = subprocess.run(
+        [sys.executable, str(repo / "bin" / "mqstat"), "--history", "week", "--history-db", str(db)],
+        text=True,
+        capture_output=True,
+        check=True,
+    )
+    assert "No usage recorded" in result.stdout
+
+
+def _predict_nodes():
+    def node(name, total_cpu, used_cpu, total_mem, used_mem, state="free", total_gpu=0, used_gpu=0):
+        return {'name': name, 'total_cpu': total_cpu, 'used_cpu': used_cpu, 'total_mem': total_mem,
+                'used_mem': used_mem, 'total_gpu': total_gpu, 'used_gpu': used_gpu, 'pbs_state': state}
+    return [
+        node('cpu1', 64, 56, 512, 100),  # 8 CPUs free
+        node('cpu2', 64, 48, 512, 480),  # 16 CPUs free but only 32 GB
+        node('cpu3', 64, 0, 512, 0, state='offline'),
+        node('gpu1', 64, 0, 512, 0, total_gpu=4),
+    ]
+
+
+def _predict_jobs(ncpus, mem_gb, hours, waits):
+    return [{'id': f'{i}.server', 'ncpus': ncpus, 'mem_request_gb': mem_gb, 'ngpus': 0,
+             'walltime_total': hours * 3600, 'qtime': 1000, 'start_time': 1000 + wait, 'state': 'F'}
+            for i, wait in enumerate(waits)]
+
+
+def test_node_fit_counts():
+    repo = Path(__file__).resolve().parents[1]
+    import runpy
+    mod = runpy.run_path(str(repo / "bin" / "mqstat"))
+    nodes = _predict_nodes()
+    # The offline node and the GPU node are never used for a CPU job.
+    assert mod['node_fit_counts'](nodes, 8, 32) == (2, 2, 2)
+    assert mod['node_fit_counts'](nodes, 16, 64) == (0, 2, 2)
+    assert mod['node_fit_counts'](nodes, 128, 64) == (0, 0, 2)
+    assert mod['node_fit_counts'](nodes, 8, 32, ngpus=1) == (1, 1, 1)
+
+
+def test_predict_wait_and_suggestion():
+    repo = Path(__file__).resolve().parents[1]
+    import runpy
+    mod = runpy.run_path(str(repo / "bin" / "mqstat"))
+    nodes = _predict_nodes()
+    jobs = (_predict_jobs(16, 64, 24, [3600, 7200, 7200, 10800, 14400])
+            # Too different in CPUs or walltime to count as similar.
+            + _predict_jobs(4, 64, 24, [60] * 5)
+            + _predict_jobs(16, 64, 1, [0] * 5))
+
+    prediction = mod['predict_wait'](nodes, jobs, 16, 64, 0, 24)
+    assert prediction['fit_now'] == 0
+    assert prediction['waits'] == [3600, 7200, 7200, 10800, 14400]
+    assert prediction['estimate'] == 7200
+
+    # Halving either CPUs or RAM fits on a node now; keep the CPUs.
+    suggestion = mod['suggest_shape'](nodes, jobs, prediction)
+    assert (suggestion['ncpus'], suggestion['mem_gb']) == (16, 32)
+    assert suggestion['estimate'] == 0
+
+    # Fewer than MIN_SIMILAR_JOBS within 2x, so look within 4x.
+    wider = mod['predict_wait'](nodes, jobs[:3] + jobs[5:], 16, 64, 0, 24)
+    assert wider['similarity_factor'] == 4
+    assert sorted(wider['waits']) == [60] * 5 + [3600, 7200, 7200]
+
+    too_big = mod['predict_wait'](nodes, jobs, 128, 64, 0, 24)
+    assert too_big['estimate'] is None
+    assert mod['suggest_shape'](nodes, jobs, too_big) is None
+
+
+def test_predict_cli(capsys, monkeypatch):
+    repo = Path(__file__).resolve().parents[1]
+    import runpy
+    mod = runpy.run_path(str(repo / "bin" / "mqstat"))
+    g = mod['main'].__globals__
+    g['parse_pbsnodes_output'] = lambda timeout=None: _predict_nodes()
+    g['parse_qstat'] = lambda path=None, include_history=False, timeout=None: _predict_jobs(16, 64, 24, [7200] * 5)
+    monkeypatch.setattr(sys, "argv", ["mqstat", "--predict", "-t", "16", "-m", "64", "--hours", "24"])
+    mod['main']()
+    out = ANSI.sub('', capsys.readouterr().out)
+    assert "Nodes with room now: 0 of 2 (2 big enough when empty)" in out
+    assert "Estimated wait: about 02:00 (HH:MM)" in out
+    assert "Suggestion: -t 16 -m 32 should start now (1 nodes have room)" in out
+
+
+def test_parse_qstat_folds_array_subjobs():
+    repo = Path(__file__).resolve().parents[1]
+    import json, runpy
+    mod = runpy.run_path(str(repo / "bin" / "mqstat"))
+    jobs = mod['parse_qstat'](path=str(repo / "tests" / "data" / "qstat_f_array.txt"))
+    assert [j['id'] for j in jobs] == ['100.server', '500[].server']
+    parent = jobs[1]
+    assert parent['state'] == 'B'
+    subjobs = parent['subjobs']
+    assert len(subjobs) == 4
+    assert subjobs.summary() == "2/4 done, 1 failed, 1 running"
+    expanded = list(subjobs.expand(parent))
+    assert [(j['id'], j['state'], j['walltime_used'], j.get('exit_status')) for j in expanded] == [
+        ('500[1].server', 'X', 600, 0),
+        ('500[2].server', 'X', 1200, 1),
+        ('500[3].server', 'R', 300, None),
+        ('500[4].server', 'Q', 0, None),
+    ]
+    assert expanded[2]['cpupercent'] == 150
+    assert expanded[0]['walltime'] == 3000
+    assert expanded[0]['ncpus'] == 2
+
+    with open(repo / "tests" / "data" / "qstat_array.json") as f:
+        from_json = mod['parse_qstat_json'](json.load(f)['Jobs'].items())
+    for job in from_json + jobs:
+        job.pop('user')
+    assert [dict(j, subjobs=None) for j in from_json] == [dict(j, subjobs=None) for j in jobs]
+    assert list(from_json[1]['subjobs'].expand(from_json[1])) == list(subjobs.expand(parent))
+
+
+def test_parse_qstat_subjob_before_parent():
+    repo = Path(__file__).resolve().parents[1]
+    import runpy
+    mod = runpy.run_path(str(repo / "bin" / "mqstat"))
+    lines = (
+        "Job Id: 7[2].server\n"
+        "    job_state = R\n"
+        "    Resource_List.ncpus = 4\n"
+        "    resources_used.walltime = 00:01:00\n"
+        "Job Id: 7[].server\n"
+        "    Job_Name = late_parent\n"
+        "    job_state = B\n"
+        "    Resource_List.ncpus = 4\n"
+        "Job Id: 7[3].server\n"
+        "    job_state = Q\n"
+    ).splitlines(True)
+    jobs = mod['parse_qstat_f'](lines)
+    assert len(jobs) == 1
+    assert jobs[0]['name'] == 'late_parent'
+    assert 'walltime_used' not in jobs[0]
+    assert [(j['id'], j['state']) for j in jobs[0]['subjobs'].expand(jobs[0])] == [
+        ('7[2].server', 'R'), ('7[3].server', 'Q')]
+
+
+def test_subjob_standing_in_for_parent_keeps_its_usage_to_itself():
+    repo = Path(__file__).resolve().parents[1]
+    import runpy
+    mod = runpy.run_path(str(repo / "bin" / "mqstat"))
+    subjob = (
+        "Job Id: 8[{}].server\n"
+        "    Job_Owner = user@host\n"
+        "    queue = batch\n"
+        "    job_state = R\n"
+        "    stime = Fri Aug 22 20:30:34 2025\n"
+        "    Resource_List.ncpus = 4\n"
+        "    Resource_List.ngpus = 0\n"
+        "    Resource_List.walltime = 01:00:00\n"
+        "    resources_used.mem = 1048576kb\n"
+        "    resources_used.vmem = 2097152kb\n"
+        "    resources_used.cput = 00:04:00\n"
+        "    resources_used.ncpus = 4\n"
+        "    resources_used.walltime = 00:01:00\n"
+    )
+    # The parent's own record never arrives.
+    jobs = mod['parse_qstat_f']("".join(subjob.format(i) for i in (1, 2, 3)).splitlines(True))
+    [parent] = jobs
+    for key in ('start_time', 'cput_used', 'ncpus_used', 'vmem_used_kb'):
+        assert key not in parent
+    expanded = list(mod['expand_array_jobs'](jobs))
+    assert len(expanded) == 3
+    # Not the first subjob's memory, three times over.
+    assert sum(j['mem_usage'] for j in expanded) == 0
+    assert mod['calculate_user_stats'](jobs)['total_memory_kb'] == 0
+    assert not any('start_time' in j or 'cput_used' in j for j in expanded)
+
+
+def test_parse_qstat_max_jobs_ignores_subjobs():
+    repo = Path(__file__).resolve().parents[1]
+    import runpy
+    os.environ.pop("MQSTAT_QSTAT_F", None)
+    mod = runpy.run_path(str(repo / "bin" / "mqstat"))
+    with open(repo / "tests" / "data" / "qstat_f_array.txt") as f:
+        text = f.read()
+
+    def fake_stream_command(cmd, timeout=None):
+        yield from text.splitlines(True)
+
+    mod['parse_qstat'].__globals__['stream_command'] = fake_stream_command
+    jobs = mod['parse_qstat'](max_jobs=2)
+    assert mod['parse_qstat'].limit_hit is False
+    assert len(jobs[1]['subjobs']) == 4
+
+
+def test_user_stats_count_subjobs():
+    repo = Path(__file__).resolve().parents[1]
+    import runpy
+    mod = runpy.run_path(str(repo / "bin" / "mqstat"))
+    jobs = mod['parse_qstat'](path=str(repo / "tests" / "data" / "qstat_f_array.txt"))
+    stats = mod['calculate_user_stats'](jobs)
+    assert stats['total_jobs'] == 5
+    assert stats['job_status']['running'] == 2
+    assert stats['job_status']['queued'] == 1
+    assert stats['running_cpu'] == 3
+    assert stats['running_cpu_utilisation'] == (90 + 150) / 3
+
+
+def test_mqstat_list_array_jobs():
+    repo = Path(__file__).resolve().parents[1]
+    script = repo / "bin" / "mqstat"
+    qstat_file = repo / "tests" / "data" / "qstat_f_array.txt"
+    result = subprocess.run(
+        [sys.executable, str(script), "--list", "--qstat-file", str(qstat_file)],
+        text=True, capture_output=True, check=True,
+    )
+    rows = [split_cols(line) for line in result.stdout.splitlines()[1:]]
+    assert [r[0] for r in rows] == ['100.server', '500[].server']
+    assert rows[1][-1] == "2/4 done, 1 failed, 1 running"
+
+    result = subprocess.run(
+        [sys.executable, str(script), "--list", "--expand-arrays", "--qstat-file", str(qstat_file)],
+        text=True, capture_output=True, check=True,
+    )
+    rows = [split_cols(line) for line in result.stdout.splitlines()[1:]]
+    assert [r[0] for r in rows] == ['100.server', '500[1].server', '500[2].server', '500[3].server', '500[4].server']
@@ -0,0 +1,246 @@
+import hashlib
+import os
+import re
+import runpy
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+MQSUB = Path(__file__).resolve().parents[1] / "bin" / "mqsub"
+
+
+def run_mqsub(cwd, *args):
+    result = subprocess.run(
+        [sys.executable, str(MQSUB), "--dry-run", *args],
+        cwd=cwd,
+        text=True,
+        capture_output=True,
+        check=True,
+    )
+    return result.stdout
+
+
+def test_chunk_array_submits_one_array_job(tmp_path):
+    (tmp_path / "cmds.txt").write_text("echo a\nfalse\necho b\nread x; echo got:$x\necho c\n")
+    out = run_mqsub(tmp_path, "--command-file", "cmds.txt", "--chunk-num", "2", "--chunk-array")
+
+    start = re.search(r"^1\t", out, re.M).start()
+    script, chunk_lines = out[:start], out[start:]
+    assert script.count("#!/bin/bash") == 1
+    assert "#PBS -J 1-2" in script
+    assert "#PBS -N echo\n" in script
+    assert chunk_lines.split("\n")[:5] == ["1\techo a", "1\tfalse", "1\techo b", "2\tread x; echo got:$x", "2\techo c"]
+    # The chunk file is not left behind by a dry run.
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["cmds.txt"]
+
+    # Run the chunk part of the script as each subjob would.
+    chunk_file = re.search(r"'([^']*\.chunks\.tsv)'", script).group(1)
+    Path(chunk_file).write_text(chunk_lines.rstrip("\n") + "\n")
+    body = script[script.index("NUM_FAILED=0"):]
+    first = subprocess.run(["bash", "-c", body], env={"PBS_ARRAY_INDEX": "1"}, input="",
+                           text=True, capture_output=True)
+    assert first.stdout.splitlines() == ["Running chunk 1 of 2", "a", "b", "Number of failed commands: 1"]
+    # Commands still read the job's stdin, not the chunk file.
+    second = subprocess.run(["bash", "-c", body], env={"PBS_ARRAY_INDEX": "2"}, input="line\n",
+                            text=True, capture_output=True)
+    assert second.stdout.splitlines() == ["Running chunk 2 of 2", "got:line", "c", "Number of failed commands: 0"]
+
+
+def test_chunks_are_separate_jobs_by_default(tmp_path):
+    (tmp_path / "cmds.txt").write_text("echo a\necho b\necho c\n")
+    out = run_mqsub(tmp_path, "--command-file", "cmds.txt", "--chunk-size", "2")
+    assert out.count("#!/bin/bash") == 2
+    assert "#PBS -J" not in out
+    assert "#PBS -N echo1\n" in out and "#PBS -N echo2\n" in out
+    assert "MQSUB_START=$SECONDS; echo c\nmqsub_record $? " in out
+
+
+def test_work_queue_runs_each_command_once(tmp_path):
+    commands = ["sleep 0.0{}; echo {} >> out.txt".format(i % 3, i) for i in range(40)] + ["false", "echo 'héllo'"]
+    (tmp_path / "cmds.txt").write_text("\n".join(commands) + "\n")
+    out = run_mqsub(tmp_path, "--command-file", "cmds.txt", "--chunk-num", "3", "--work-queue")
+
+    assert out.count("#!/bin/bash") == 3
+    assert "#PBS -N sleep1\n" in out and "#PBS -N sleep3\n" in out
+    queue_file = re.search(r"MQSUB_QUEUE='([^']*\.queue)'", out).group(1)
+    queue_lines = out[out.index(commands[0] + "\n", out.rindex("exec 9>&-")):]
+    Path(queue_file).write_text(queue_lines.rstrip("\n") + "\n")
+    script = out[:out.index("#!/bin/bash", 1)]
+    body = script[script.index("NUM_FAILED=0"):]
+
+    # Three workers share the queue, and a fourth joins once it is empty.
+    workers = [subprocess.Popen(["bash", "-c", body], cwd=tmp_path, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, text=True) for _ in range(3)]
+    outputs = [w.communicate()[0] for w in workers]
+    late = subprocess.run(["bash", "-c", body], cwd=tmp_path, text=True, capture_output=True)
+
+    lines = (tmp_path / "out.txt").read_text().split()
+    assert sorted(map(int, lines)) == list(range(40))
+    assert sum("Running command" in o for o in "".join(outputs).splitlines()) == 42
+    assert "héllo" in "".join(outputs)
+    assert sum(int(re.search(r"failed commands: (\d+)", o).group(1)) for o in outputs) == 1
+    assert late.stdout.splitlines() == ["Number of failed commands: 0"]
+
+
+def test_chunk_parallel_runs_commands_in_slots(tmp_path):
+    # Each command waits for the next to start, so they only all finish if
+    # they run at the same time.
+    commands = ["touch s{0}; until [ -e s{1} ]; do sleep 0.01; done; echo {0}".format(i, (i + 1) % 3) for i in range(3)]
+    commands.append("exit 3")
+    (tmp_path / "cmds.txt").write_text("\n".join(commands) + "\n")
+    out = run_mqsub(tmp_path, "--command-file", "cmds.txt", "--chunk-num", "1", "--chunk-parallel", "3", "--slot-mem", "1")
+
+    assert "MQSUB_SLOT_MEM_KB=1048576" in out
+    body = out[out.index("NUM_FAILED=0"):]
+    env = {"PATH": os.environ["PATH"], "TMPDIR": str(tmp_path), "PBS_JOBNAME": "job1", "PBS_JOBID": "12.aqua"}
+    result = subprocess.run(["bash", "-c", body], cwd=tmp_path, env=env, text=True,
+                            capture_output=True, timeout=30)
+    assert result.stdout.splitlines()[-1] == "Number of failed commands: 1"
+    assert sorted(line for line in result.stdout.splitlines() if line.isdigit()) == ["0", "1", "2"]
+
+    results = [line.split("\t") for line in (tmp_path / "job1.12.results.tsv").read_text().splitlines()]
+    assert sorted(r[0] for r in results) == ["1", "2", "3", "4"]
+    assert {r[0]: r[1] for r in results}["4"] == "3"
+    assert all(r[2].isdigit() for r in results)
+    assert {r[3] for r in results} == set(commands)
+    # The queue on the node is removed.
+    assert not list(tmp_path.glob("mqsub.*"))
+
+    # Virtual memory is only limited when asked.
+    out = run_mqsub(tmp_path, "--command-file", "cmds.txt", "--chunk-num", "1", "--chunk-parallel", "3")
+    assert "MQSUB_SLOT_MEM_KB=0" in out
+
+
+def test_resume_skips_commands_that_succeeded(tmp_path):
+    (tmp_path / "cmds.txt").write_text("echo a\nfalse\necho 'b c'\n")
+    out = run_mqsub(tmp_path, "--command-file", "cmds.txt", "--chunk-num", "1")
+    body = out[out.index("NUM_FAILED=0"):]
+    env = {"PATH": os.environ["PATH"], "PBS_JOBID": "7.aqua"}
+    result = subprocess.run(["bash", "-c", body], cwd=tmp_path, env=env, text=True, capture_output=True)
+    assert result.stdout.splitlines() == ["a", "b c", "Number of failed commands: 1"]
+    assert [p.name for p in (tmp_path / "cmds.txt.ledger").iterdir()] == ["7.aqua.0.tsv"]
+
+    out = run_mqsub(tmp_path, "--command-file", "cmds.txt", "--chunk-num", "1", "--resume")
+    assert "MQSUB_START=$SECONDS; false\n" in out
+    assert "echo a" not in out and "echo 'b c'" not in out
+    # Only one command is left, so only one job is submitted.
+    out = run_mqsub(tmp_path, "--command-file", "cmds.txt", "--chunk-num", "3", "--resume")
+    assert out.count("#!/bin/bash") == 1
+
+    (tmp_path / "cmds.txt").write_text("echo a\n")
+    result = subprocess.run([sys.executable, str(MQSUB), "--dry-run", "--command-file", "cmds.txt",
+                             "--chunk-num", "1", "--resume"], cwd=tmp_path, text=True, capture_output=True)
+    assert result.returncode == 0 and result.stdout == ""
+    assert "nothing to submit" in result.stderr
+
+
+def test_balanced_packs_longest_first():
+    splitter = runpy.run_path(str(MQSUB))["splitter"]
+    chunks, loads = splitter.balanced(list("abcdef"), [1, 9, 4, 4, 3, 2], 3)
+    assert chunks == [["b"], ["c", "e"], ["d", "f", "a"]]
+    assert loads == [9, 7, 7]
+    # Chunks that would be empty are left out.
+    assert splitter.balanced(["a"], [1], 3) == ([["a"]], [1])
+
+
+def test_balance_uses_ledger_durations_and_walltime(tmp_path):
+    commands = ["echo {}".format(i) for i in range(6)]
+    (tmp_path / "cmds.txt").write_text("\n".join(commands) + "\n")
+    ledger = tmp_path / "cmds.txt.ledger"
+    ledger.mkdir()
+    # Command 0 took 3 hours, 1 and 2 took 1 hour, the others are unknown
+    # and so assumed to take the mean of 5/3 hours.
+    hashes = [hashlib.sha1(c.encode()).hexdigest() for c in commands]
+    (ledger / "1.aqua.0.tsv").write_text("".join(
+        "{}\t0\t{}\t1700000000\t1.aqua\n".format(h, s) for h, s in zip(hashes, [10800, 3600, 3600])))
+
+    def chunks(*args):
+        out = run_mqsub(tmp_path, "--command-file", "cmds.txt", "--balance", *args)
+        return [re.findall(r"^MQSUB_START=\$SECONDS; (.*)$", script, re.M) for script in out.split("#!/bin/bash")[1:]]
+
+    # 10 hours of commands fit in 3 chunks of 4 hours.
+    assert chunks("--chunk-num", "3", "--hours", "4") == [["echo 0"], ["echo 3", "echo 5"], ["echo 4", "echo 1", "echo 2"]]
+    # Left to choose, mqsub uses enough chunks for all to finish when the
+    # longest command does.
+    assert chunks("--hours", "4") == [["echo 0"], ["echo 3", "echo 1"], ["echo 4", "echo 2"], ["echo 5"]]
+    assert len(chunks("--chunk-num", "1", "--hours", "2")) == 6
+
+    # With no earlier run times, the number of chunks must be given.
+    (tmp_path / "new.txt").write_text("echo x\necho y\n")
+    result = subprocess.run([sys.executable, str(MQSUB), "--dry-run", "--command-file", "new.txt", "--balance"],
+                            cwd=tmp_path, text=True, capture_output=True)
+    assert result.returncode != 0 and "Please specify --chunk-num or --chunk-size" in result.stderr
+    out = run_mqsub(tmp_path, "--command-file", "new.txt", "--balance", "--chunk-num", "2")
+    assert out.count("#!/bin/bash") == 2
+
+
+
+def test_balance_with_commands_that_take_no_time(tmp_path):
+    commands = ["echo {}".format(i) for i in range(3)]
+    # Commands that finished within a second are recorded as taking 0.
+    (tmp_path / "cmds.txt").write_text("\n".join(commands) + "\n")
+    ledger = tmp_path / "cmds.txt.ledger"
+    ledger.mkdir()
+    (ledger / "1.aqua.0.tsv").write_text("".join(
+        "{}\t0\t0\t1700000000\t1.aqua\n".format(hashlib.sha1(c.encode()).hexdigest()) for c in commands))
+    out = run_mqsub(tmp_path, "--command-file", "cmds.txt", "--balance")
+    assert out.count("#!/bin/bash") == 1
+    assert all("MQSUB_START=$SECONDS; {}\n".format(c) in out for c in commands)
+
+    (tmp_path / "weights.txt").write_text("".join("0\t{}\n".format(c) for c in commands))
+    out = run_mqsub(tmp_path, "--command-file", "weights.txt", "--weights")
+    assert out.count("#!/bin/bash") == 1
+    assert all("MQSUB_START=$SECONDS; {}\n".format(c) in out for c in commands)
+
+
+def test_scratch_data_is_staged_through_the_node_cache(tmp_path):
+    (tmp_path / "db").mkdir()
+    (tmp_path / "cmds.txt").write_text("echo a\n")
+    out = run_mqsub(tmp_path, "--command-file", "cmds.txt", "--chunk-num", "1", "--scratch-data", "db")
+    assert "-m hpc_scripts.stage_cache acquire --cache /scratch/cmr_mqsub/cache/$USER" in out
+    assert "-m hpc_scripts.stage_cache release --cache /scratch/cmr_mqsub/cache/$USER" in out
+    assert "cp -r -L" not in out
+    # With no room in the cache, the job copies the data itself.
+    (tmp_path / "db" / "f").write_text("data")
+    (tmp_path / "scratch").mkdir()
+    stage = re.search(r"^MQSUB_STAGED=.*$", out, re.M).group(0)
+    stage = re.sub(r"\$\(.*?\) &&", "$(exit 3) &&", stage)
+    result = subprocess.run(["bash", "-c", stage], env={"PATH": os.environ["PATH"], "MSCRATCH": str(tmp_path / "scratch")},
+                            text=True, capture_output=True)
+    assert result.returncode == 0, result.stderr
+    assert (tmp_path / "scratch" / "db" / "f").read_text() == "data"
+    shutil.rmtree(tmp_path / "scratch")
+
+    out = run_mqsub(tmp_path, "--command-file", "cmds.txt", "--chunk-num", "1", "--tmp-data", "db")
+    assert "-m hpc_scripts.stage_cache release --cache /tmp/cmr_mqsub_cache/$USER --ref \"$PBS_JOBID\" --evict" in out
+
+    out = run_mqsub(tmp_path, "--command-file", "cmds.txt", "--chunk-num", "1", "--scratch-data", "db", "--no-stage-cache")
+    assert "-m hpc_scripts.parallel_copy '{}' $MSCRATCH".format(tmp_path / "db") in out
+    assert "stage_cache" not in out
+    # Run the staging as the job would.
+    (tmp_path / "scratch").mkdir()
+    stage = re.search(r"^.*-m hpc_scripts.parallel_copy.*$", out, re.M).group(0)
+    result = subprocess.run(["bash", "-c", stage], env={"PATH": os.environ["PATH"], "MSCRATCH": str(tmp_path / "scratch")},
+                            text=True, capture_output=True)
+    assert result.returncode == 0, result.stderr
+    assert (tmp_path / "scratch" / "db" / "f").read_text() == "data"
+    assert "MB/s" in result.stderr
+
+
+def test_job_exits_with_the_command_status_after_cleaning_up(tmp_path):
+    (tmp_path / "db").mkdir()
+    (tmp_path / "work").mkdir()
+    # A single command's script is logged rather than printed.
+    out = subprocess.run(
+        [sys.executable, str(MQSUB), "--dry-run", "--tmp-data", str(tmp_path / "db"), "--run-tmp-dir",
+         "--", "bash", "-c", "'touch out; exit 3'"],
+        cwd=tmp_path / "work", text=True, capture_output=True, check=True).stderr
+    body = out[out.index("export MQSUB_TMPDIR"):out.index("\nexit $FINAL_EXITSTATUS") + len("\nexit $FINAL_EXITSTATUS")]
+    # Releasing the staged copy comes after the command's status is saved.
+    assert body.index("FINAL_EXITSTATUS=$?") < body.index("stage_cache release")
+    body = re.sub(r"^.*stage_cache release.*$", "true", body, flags=re.M)
+    result = subprocess.run(["bash", "-c", body], env={"PATH": os.environ["PATH"], "TMPDIR": str(tmp_path)},
+                            text=True, capture_output=True)
+    assert result.returncode == 3, result.stderr
+    assert (tmp_path / "work" / "out").exists()
@@ -1,9 +1,13 @@
+import os
 import subprocess
 import sys
 import re
 import pstats
 from pathlib import Path
 
+# Keep parsed job lists out of the user's cache directory.
+os.environ["MQTOP_CACHE_DIR"] = ""
+
 ANSI = re.compile(r"\x1b\[[0-9;]*m")
 
 
@@ -44,6 +48,9 @@ def test_mqtop_print_first_page():
         "cpu%",
         "RAM(G)",
         "ram%",
+        "peak(G)",
+        "cpu history",
+        "mem history",
         "state",
         "queue",
         "note",
@@ -133,6 +140,9 @@ def test_mqtop_history_only_print_first_page():
         "cpu%",
         "RAM(G)",
         "ram%",
+        "peak(G)",
+        "cpu history",
+        "mem history",
         "state",
         "queue",
         "note",
@@ -165,3 +175,332 @@ def test_mqtop_profile(tmp_path):
     stats = pstats.Stats(str(prof))
     assert any("get_jobs" in func for (_, _, func) in stats.stats)
 
+
+
+def test_mqtop_array_jobs_summarised_and_expanded():
+    repo = Path(__file__).resolve().parents[1]
+    import runpy
+    mod = runpy.run_path(str(repo / "bin" / "mqtop"))
+    jobs = mod["_load_jobs_from_json"](str(repo / "tests" / "data" / "qstat_array.json"), "root")
+    assert [j["id"] for j in jobs] == ["100.server", "500[].server"]
+
+    lines, rows = mod["format_jobs"](jobs, 200)
+    assert len(rows) == 2
+    assert split_cols(lines[2])[-1] == "2/4 done, 1 failed, 1 running"
+
+    shown = mod["with_expanded_arrays"](jobs, {"500[].server"})
+    lines, rows = mod["format_jobs"](shown, 200)
+    assert [r["id"] for r in rows] == [
+        "100.server", "500[].server", "500[1].server", "500[2].server", "500[3].server", "500[4].server"]
+    # Finished subjobs are coloured like finished jobs, by exit status.
+    assert lines[3].startswith("\x1b[92m")
+    assert lines[4].startswith("\x1b[91m")
+    assert "└ arrayjob" in ANSI.sub("", lines[3])
+
+
+def test_job_loader_runs_in_background():
+    repo = Path(__file__).resolve().parents[1]
+    import runpy, threading, time
+    mod = runpy.run_path(str(repo / "bin" / "mqtop"))
+    g = mod["JobLoader"].__init__.__globals__
+    release = threading.Event()
+    loads = []
+
+    def slow_load(path, user):
+        loads.append(path)
+        release.wait(5)
+        return [{"id": f"{path}.1", "state": "R" if path == "active" else "F"}]
+
+    g["_load_jobs_from_json"] = slow_load
+    g["_recent_finished_jobs"] = lambda user, existing: [{"id": "recent.1", "state": "F"}]
+
+    loader = mod["JobLoader"]("active", "history", "root")
+    start = time.monotonic()
+    for _ in range(3):
+        loader.request()
+    # Asking for jobs never waits for the PBS server.
+    assert time.monotonic() - start < 0.05
+    assert loader.loading
+    assert loader.poll() == []
+
+    release.set()
+    messages = []
+    deadline = time.monotonic() + 5
+    while loader.loading and time.monotonic() < deadline:
+        messages += loader.poll()
+        time.sleep(0.01)
+    messages += loader.poll()
+    assert not loader.loading
+    # The first request may start before the others arrive; the rest are
+    # served together.
+    assert loads in (["active", "history"], ["active", "history"] * 2)
+    assert messages[:2] == [
+        ("active", ({"id": "active.1", "state": "R"},)),
+        ("finished", ({"id": "history.1", "state": "F"}, {"id": "recent.1", "state": "F"})),
+    ]
+
+
+def test_job_loader_reports_errors():
+    repo = Path(__file__).resolve().parents[1]
+    import runpy, time
+    mod = runpy.run_path(str(repo / "bin" / "mqtop"))
+
+    def broken_load(path, user):
+        raise OSError("qstat.json unreadable")
+
+    mod["JobLoader"].__init__.__globals__["_load_jobs_from_json"] = broken_load
+    loader = mod["JobLoader"]("active", "history", "root")
+    loader.request()
+    deadline = time.monotonic() + 5
+    while loader.loading and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert loader.poll() == [("error", "qstat.json unreadable")]
+
+
+def test_mqtop_curses_loop_draws_background_jobs(monkeypatch):
+    repo = Path(__file__).resolve().parents[1]
+    import curses, runpy, time
+    mod = runpy.run_path(str(repo / "bin" / "mqtop"))
+    mod["main"].__globals__["_recent_finished_jobs"] = lambda user, existing: []
+
+    class DummyScreen:
+        def __init__(self):
+            self.text = []
+            self.deadline = time.monotonic() + 5
+
+        def getch(self):
+            # Quit once the jobs loaded in the background are on screen.
+            drawn = "123.server" in "".join(self.text)
+            return ord("q") if drawn or time.monotonic() > self.deadline else -1
+
+        def getmaxyx(self):
+            return (24, 200)
+
+        def addstr(self, y, x, text, *args):
+            self.text.append(text)
+
+        def erase(self):
+            self.text = []
+
+        def timeout(self, ms):
+            pass
+
+        def nodelay(self, flag):
+            pass
+
+        def keypad(self, flag):
+            pass
+
+        def refresh(self):
+            pass
+
+    screen = DummyScreen()
+    for name in ("curs_set", "start_color", "use_default_colors", "init_pair", "mousemask"):
+        monkeypatch.setattr(curses, name, lambda *a, **k: None)
+    monkeypatch.setattr(curses, "color_pair", lambda n: 0)
+    monkeypatch.setattr(curses, "wrapper", lambda func: func(screen))
+    monkeypatch.setattr(sys, "argv", [
+        "mqtop", "--qstat-json", str(repo / "tests" / "data" / "qstat.json"), "--qstatx-json", "/nonexistent"])
+    mod["main"]()
+    assert time.monotonic() < screen.deadline
+
+
+def test_recent_finished_jobs_batches_and_memoises():
+    repo = Path(__file__).resolve().parents[1]
+    import json, runpy, types
+    mod = runpy.run_path(str(repo / "bin" / "mqtop"))
+    g = mod["_recent_finished_jobs"].__globals__
+    g["FETCH_CHUNK_JOBS"] = 2
+    job_ids = [f"{i}.server" for i in range(5)] + ["9.server"]
+    calls = []
+
+    def fake_run(cmd, **kwargs):
+        calls.append(cmd)
+        if cmd[0] == "qselect":
+            return types.SimpleNamespace(returncode=0, stdout="\n".join(job_ids) + "\n")
+        jobs = {
+            jid: {"job_state": "F", "euser": "other" if jid == "9.server" else "me", "Exit_status": 0}
+            for jid in cmd[4:]
+        }
+        return types.SimpleNamespace(returncode=0, stdout=json.dumps({"Jobs": jobs}))
+
+    g["subprocess"] = types.SimpleNamespace(run=fake_run)
+    jobs = mod["_recent_finished_jobs"]("me", {"0.server"})
+    assert [j["id"] for j in jobs] == ["1.server", "2.server", "3.server", "4.server"]
+    qstat_calls = sorted(c[4:] for c in calls if c[0] == "qstat")
+    assert qstat_calls == [["1.server", "2.server"], ["3.server", "4.server"], ["9.server"]]
+
+    # Finished jobs, and jobs of other users, are never fetched again.
+    calls.clear()
+    jobs = mod["_recent_finished_jobs"]("me", set())
+    assert [j["id"] for j in jobs] == ["0.server", "1.server", "2.server", "3.server", "4.server"]
+    assert [c[4:] for c in calls if c[0] == "qstat"] == [["0.server"]]
+
+
+def test_chunk_job_ids_limits_command_line_bytes():
+    repo = Path(__file__).resolve().parents[1]
+    import runpy
+    mod = runpy.run_path(str(repo / "bin" / "mqtop"))
+    mod["_chunk_job_ids"].__globals__["FETCH_CHUNK_BYTES"] = 25
+    chunks = mod["_chunk_job_ids"]([f"{i}.server" for i in range(100, 105)])
+    assert chunks == [["100.server", "101.server"], ["102.server", "103.server"], ["104.server"]]
+    assert mod["_chunk_job_ids"]([]) == []
+
+
+def test_load_jobs_from_json_reuses_parse_of_unchanged_file(tmp_path):
+    repo = Path(__file__).resolve().parents[1]
+    import runpy, shutil
+    mod = runpy.run_path(str(repo / "bin" / "mqtop"))
+    g = mod["_load_jobs_from_json"].__globals__
+    g["PARSE_CACHE_DIR"] = str(tmp_path / "cache")
+    parse = g["_parse_jobs_from_json"]
+    parsed = []
+
+    def counting_parse(path, user):
+        parsed.append(path)
+        return parse(path, user)
+
+    g["_parse_jobs_from_json"] = counting_parse
+    snapshot = tmp_path / "qstat.json"
+    shutil.copy(repo / "tests" / "data" / "qstat_array.json", snapshot)
+
+    first = mod["_load_jobs_from_json"](str(snapshot), "root")
+    assert mod["_load_jobs_from_json"](str(snapshot), "root") == first
+    assert len(parsed) == 1
+
+    # A new mqtop reads the parse from disk.
+    g["_parse_cache"].clear()
+    again = mod["_load_jobs_from_json"](str(snapshot), "root")
+    assert [j["id"] for j in again] == [j["id"] for j in first]
+    assert again[1]["subjobs"].summary() == first[1]["subjobs"].summary()
+    assert len(parsed) == 1
+
+    # A replaced snapshot is parsed again.
+    replacement = tmp_path / "qstat.json.new"
+    shutil.copy(repo / "tests" / "data" / "qstat_array.json", replacement)
+    os.replace(replacement, snapshot)
+    mod["_load_jobs_from_json"](str(snapshot), "root")
+    assert len(parsed) == 2
+
+
+def test_load_jobs_from_json_reads_only_users_shard(tmp_path):
+    repo = Path(__file__).resolve().parents[1]
+    import json, runpy
+    mod = runpy.run_path(str(repo / "bin" / "mqtop"))
+    snapshot = tmp_path / "qstat.json"
+    snapshot.write_text(json.dumps({"Jobs": {}}))
+    st = snapshot.stat()
+    shard_dir = tmp_path / "qstat.json.shards" / "1"
+    shard_dir.mkdir(parents=True)
+    line = json.dumps({"id": "7.server", "job_state": "R", "euser": "root"}) + "\n"
+    (shard_dir / "root.ndjson").write_text(line)
+    index = {
+        "version": 1,
+        "source": {"inode": st.st_ino, "size": st.st_size, "mtime_ns": st.st_mtime_ns},
+        "dir": "qstat.json.shards/1",
+        "users": {"root": {"file": "root.ndjson", "bytes": len(line), "jobs": 1, "states": {"R": 1}}},
+    }
+    (tmp_path / "qstat.json.shards.json").write_text(json.dumps(index))
+
+    assert [j["id"] for j in mod["_load_jobs_from_json"](str(snapshot), "root")] == ["7.server"]
+    assert mod["_load_jobs_from_json"](str(snapshot), "nobody") == []
+
+    # Shards of an older snapshot are ignored.
+    snapshot.write_text(json.dumps({"Jobs": {"8.server": {"job_state": "Q", "euser": "root"}}}))
+    assert [j["id"] for j in mod["_load_jobs_from_json"](str(snapshot), "root")] == ["8.server"]
+
+
+def test_wall_clock_to_timestamp_matches_parse_time():
+    repo = Path(__file__).resolve().parents[1]
+    import calendar, runpy, time
+    mod = runpy.run_path(str(repo / "bin" / "mqtop"))
+    old_tz = os.environ.get("TZ")
+    os.environ["TZ"] = "Europe/London"
+    time.tzset()
+    try:
+        # Includes the hours skipped and repeated at daylight saving changes.
+        for value in ["Mon Jan  1 10:00:00 2024", "Sun Mar 31 00:59:59 2024", "Sun Mar 31 01:30:00 2024",
+                      "Sun Mar 31 02:15:00 2024", "Sun Oct 27 01:30:00 2024", "Sun Oct 27 02:00:01 2024"]:
+            wall = calendar.timegm(time.strptime(value, "%a %b %d %H:%M:%S %Y"))
+            assert mod["_wall_clock_to_timestamp"](wall) == mod["_parse_time"](value)
+    finally:
+        if old_tz is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = old_tz
+        time.tzset()
+
+
+def test_format_jobs_renders_only_rows_read():
+    repo = Path(__file__).resolve().parents[1]
+    import runpy
+    mod = runpy.run_path(str(repo / "bin" / "mqtop"))
+    now = 1_700_000_000
+    jobs = [
+        {"id": f"{i}.aqua", "queue": "cpu_batch_exec", "state": "R", "name": f"job{i}",
+         "walltime_used": 3600 * (i % 3), "walltime_total": 3600, "ncpus": 1}
+        for i in range(20000)
+    ]
+    table, rows = mod["format_jobs"](jobs, 200, now=now)
+    assert len(table) == 20001 and len(rows) == 20000
+    page = table[1000:1010]
+    assert len(table._lines) == 10
+    assert split_cols(page[0])[:2] == ["999", "job999"]
+    # Bars of jobs past their walltime make some lines longer than the header.
+    assert table.width == max(mod["visible_len"](line) for line in table[:]) > len(table.header)
+
+    # Rows of the same jobs are reused by the next table.
+    row_cache = {}
+    first, _ = mod["format_jobs"](jobs[:5], 200, now=now, row_cache=row_cache)
+    second, _ = mod["format_jobs"](jobs[:3], 200, now=now + 1, row_cache=row_cache)
+    assert second._rows == first._rows[:3] and all(a is b for a, b in zip(second._rows, first._rows))
+    assert len(row_cache) == 3
+
+
+def test_format_jobs_shows_sampled_history():
+    repo = Path(__file__).resolve().parents[1]
+    import runpy
+    mod = runpy.run_path(str(repo / "bin" / "mqtop"))
+    samples = mod["JobSamples"]()
+    job = {"id": "1.aqua", "queue": "cpu_batch_exec", "state": "R", "name": "job", "ncpus": 2,
+           "ncpus_used": 2, "mem_request_gb": 4.0, "walltime_total": 3600}
+    row_cache = {}
+    for i, (cpu, mem_gb) in enumerate([(200, 1), (20, 3), (100, 2)]):
+        snapshot = dict(job, cpupercent=cpu, mem_usage=mem_gb * 1024 * 1024, walltime_used=60 * (i + 1))
+        samples.record([snapshot], now=1_700_000_000 + i)
+        table, _ = mod["format_jobs"]([snapshot], 200, now=1_700_000_000, row_cache=row_cache, samples=samples)
+    fields = dict(zip([name for name, _, _ in mod["TABLE_COLUMNS"]], table._rows[0]["fields"]))
+    # The last sample shows 2G in use, but 3G was the peak.
+    assert fields["peak"] == "3.0"
+    assert fields["cpu_hist"] == "█▁▅"
+    assert fields["mem_hist"] == "▃▇▅"
+    assert "▃▇▅" in table[1]
+
+
+def test_replay_times_each_stage_without_a_terminal(tmp_path):
+    repo = Path(__file__).resolve().parents[1]
+    import runpy, time
+    sys.path.insert(0, str(repo))
+    from hpc_scripts.synthetic_qstat import write_replay_dir
+
+    write_replay_dir(str(tmp_path), snapshots=3, num_jobs=40, other_jobs=400)
+    mod = runpy.run_path(str(repo / "bin" / "mqtop"))
+    mod["replay"].__globals__["QSTAT_FILTER"] = str(tmp_path / "missing")
+    times = mod["STAGE_TIMES"]
+    assert mod["replay"](str(tmp_path), "me", loops=2) == 6
+    # Each snapshot parses qstat.json and qstatx.json.
+    assert [len(times.times[stage]) for stage in times.STAGES] == [0, 12, 6, 6]
+    report = mod["format_stage_times"](times).splitlines()
+    assert report[0].split() == ["stage", "count", "p50", "ms", "p95", "ms", "max", "ms"]
+    assert report[2].split()[:2] == ["parse", "12"]
+
+    screen = mod["HeadlessScreen"](10, 120)
+    active = mod["_load_jobs_from_json"](str(tmp_path / "0002" / "qstat.json"), "me")
+    table, rows = mod["format_jobs"](mod["order_jobs"](active, time.time()), 120)
+    selected, offset = mod["draw_screen"](screen, table, 30, 0, 0, hud=times.hud())
+    text = screen.text()
+    assert (selected, offset) == (30, 23)
+    assert text[0].startswith("job_id") and text[7].startswith(rows[29]["id"].replace(".aqua", ""))
+    # No jobs were loaded by qstat_filter, so the HUD starts with parsing.
+    assert text[8].startswith("parse ")
+    assert text[9].startswith("q quit")
@@ -0,0 +1,78 @@
+import io
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from hpc_scripts import parallel_copy
+from hpc_scripts.parallel_copy import build_manifest, copy_tree, plan, verify
+
+
+@pytest.fixture
+def small_sizes(monkeypatch):
+    monkeypatch.setattr(parallel_copy, "SMALL_FILE", 100)
+    monkeypatch.setattr(parallel_copy, "BATCH_FILES", 3)
+    monkeypatch.setattr(parallel_copy, "LARGE_FILE", 1000)
+    monkeypatch.setattr(parallel_copy, "PIECE_BYTES", 300)
+    monkeypatch.setattr(parallel_copy, "BUFFER_BYTES", 64)
+
+
+def make_tree(root):
+    (root / "sub" / "deeper").mkdir(parents=True)
+    (root / "empty").mkdir()
+    for i in range(5):
+        (root / "sub" / "small{}".format(i)).write_bytes(bytes([i]) * (10 + i))
+    (root / "sub" / "deeper" / "odd name\nwith newline").write_bytes(b"n" * 5)
+    (root / "medium").write_bytes(os.urandom(500))
+    (root / "large").write_bytes(os.urandom(1001))
+    os.chmod(root / "large", 0o750)
+    (root / "link").symlink_to("medium")
+    return root
+
+
+def test_plan_buckets_files_by_size(tmp_path, small_sizes):
+    manifest = build_manifest(str(make_tree(tmp_path / "src")))
+    kinds = [(kind, size) for kind, size, _ in plan(manifest)]
+    # The link is to "medium", so both are 500 bytes.
+    assert kinds == [("file", 500), ("file", 500), ("piece", 300), ("piece", 300), ("piece", 300),
+                     ("piece", 101), ("batch", 39), ("batch", 26)]
+    assert manifest.dirs == ["empty", "sub", "sub/deeper"]
+
+
+def test_copy_tree_matches_source(tmp_path, small_sizes):
+    source = make_tree(tmp_path / "src")
+    (tmp_path / "dest").mkdir()
+    log = io.StringIO()
+    copied = copy_tree(str(source), str(tmp_path / "dest"), streams=4, log=log)
+
+    target = tmp_path / "dest" / "src"
+    for path, size, _ in build_manifest(str(source)).files:
+        assert (target / path).read_bytes() == (source / path).read_bytes()
+    assert copied == 2 * 500 + 1001 + 60 + 5
+    assert (target / "empty").is_dir()
+    # Links are followed, as with cp -r -L.
+    assert not (target / "link").is_symlink()
+    assert os.stat(target / "large").st_mode & 0o777 == 0o750
+    assert "Copied 9 files" in log.getvalue() and "with 4 streams" in log.getvalue()
+
+    # A single file.
+    copy_tree(str(source / "large"), str(tmp_path / "dest"), log=log)
+    assert (tmp_path / "dest" / "large").read_bytes() == (source / "large").read_bytes()
+
+    (target / "medium").write_bytes(b"short")
+    with pytest.raises(Exception, match="medium has size 5"):
+        verify(build_manifest(str(source)), str(target))
+
+
+def test_copy_contents_keeps_links(tmp_path, small_sizes):
+    source = make_tree(tmp_path / "output")
+    (tmp_path / "work").mkdir()
+    (tmp_path / "work" / "existing").write_text("kept")
+    for _ in range(2):
+        copy_tree(str(source), str(tmp_path / "work"), contents=True, dereference=False, log=io.StringIO())
+    assert os.readlink(tmp_path / "work" / "link") == "medium"
+    assert (tmp_path / "work" / "sub" / "small4").read_bytes() == b"\x04" * 14
+    assert (tmp_path / "work" / "existing").read_text() == "kept"
@@ -0,0 +1,150 @@
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from hpc_scripts import pbs_snapshot
+from hpc_scripts.pbs_snapshot import PbsSnapshot
+
+
+def _counting_command(monkeypatch, tmp_path, output='{"Jobs": {}}', exit_code=0, delay=0):
+    """Point the 'qstat' snapshot at a script that logs each invocation."""
+    log = tmp_path / "calls"
+    script = tmp_path / "fake_qstat"
+    script.write_text(
+        "#!/bin/sh\n"
+        f"echo x >> {log}\n"
+        f"sleep {delay}\n"
+        f"echo '{output}'\n"
+        f"exit {exit_code}\n"
+    )
+    script.chmod(0o755)
+    monkeypatch.setitem(pbs_snapshot.SNAPSHOT_COMMANDS, 'qstat', str(script))
+    return lambda: len(log.read_text().splitlines()) if log.exists() else 0
+
+
+def test_fresh_snapshot_is_reused(monkeypatch, tmp_path):
+    calls = _counting_command(monkeypatch, tmp_path)
+    snapshot = PbsSnapshot(directory=str(tmp_path / "snap"), ttl=60)
+    assert snapshot.json('qstat') == {"Jobs": {}}
+    assert snapshot.json('qstat') == {"Jobs": {}}
+    assert PbsSnapshot(directory=str(tmp_path / "snap"), ttl=60).get('qstat') == '{"Jobs": {}}\n'
+    assert calls() == 1
+
+
+def test_stale_snapshot_is_refreshed(monkeypatch, tmp_path):
+    calls = _counting_command(monkeypatch, tmp_path)
+    snapshot = PbsSnapshot(directory=str(tmp_path / "snap"), ttl=60)
+    snapshot.get('qstat')
+    old = time.time() - 120
+    os.utime(snapshot.path('qstat'), (old, old))
+    snapshot.get('qstat')
+    assert calls() == 2
+
+
+def test_failed_command_is_not_cached(monkeypatch, tmp_path):
+    calls = _counting_command(monkeypatch, tmp_path, exit_code=1)
+    snapshot = PbsSnapshot(directory=str(tmp_path / "snap"), ttl=60)
+    assert snapshot.get('qstat') is None
+    assert not os.path.exists(snapshot.path('qstat'))
+    assert snapshot.get('qstat') is None
+    assert calls() == 2
+    assert [p for p in os.listdir(tmp_path / "snap") if p.endswith('.tmp')] == []
+
+
+def test_ttl_zero_disables_cache(monkeypatch, tmp_path):
+    calls = _counting_command(monkeypatch, tmp_path)
+    monkeypatch.setenv("HPC_SCRIPTS_SNAPSHOT_TTL", "0")
+    snapshot = PbsSnapshot(directory=str(tmp_path / "snap"))
+    assert not snapshot.enabled
+    assert snapshot.get('qstat') is None
+    assert calls() == 0
+
+
+def test_concurrent_callers_share_one_query(monkeypatch, tmp_path):
+    calls = _counting_command(monkeypatch, tmp_path, delay=0.3)
+    results = []
+
+    def worker():
+        # Separate instances, as separate processes would have.
+        results.append(PbsSnapshot(directory=str(tmp_path / "snap"), ttl=60).get('qstat'))
+
+    threads = [threading.Thread(target=worker) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == ['{"Jobs": {}}\n'] * 5
+    assert calls() == 1
+
+
+def _other_user(path, monkeypatch):
+    """Make *path* look written by another, ordinary user, and return that user's uid."""
+    if os.getuid() == 0:
+        os.chown(path, 54321, -1)
+        return 54321
+    uid = os.getuid()
+    monkeypatch.setattr(os, "getuid", lambda: uid + 1)
+    return uid
+
+
+def test_only_trusted_copies_are_read(monkeypatch, tmp_path):
+    calls = _counting_command(monkeypatch, tmp_path)
+    directory = tmp_path / "snap"
+    directory.mkdir()
+    forged = directory / "qstat.0"
+    forged.write_text('{"Jobs": {"1.server": {}}}')
+    uid = _other_user(forged, monkeypatch)
+    forged.rename(directory / "qstat.{}".format(uid))
+    # Another user's copy is ignored, even if named after its owner.
+    assert PbsSnapshot(directory=str(directory), ttl=60).json('qstat', refresh=False) is None
+
+    # Unless that user is the trusted refresher.
+    monkeypatch.setenv("HPC_SCRIPTS_SNAPSHOT_OWNER", "nosuchuser, {}".format(uid))
+    assert PbsSnapshot(directory=str(directory), ttl=60).json('qstat', refresh=False) == {"Jobs": {"1.server": {}}}
+    assert calls() == 0
+
+
+def test_waiting_for_the_lock_is_bounded(monkeypatch, tmp_path):
+    calls = _counting_command(monkeypatch, tmp_path)
+    snapshot = PbsSnapshot(directory=str(tmp_path / "snap"), ttl=60)
+    snapshot._make_directory()
+    holder = snapshot._lock('qstat', time.time())
+    try:
+        start = time.time()
+        assert snapshot.get('qstat', timeout=0.3) is None
+        assert time.time() - start < 5
+    finally:
+        os.close(holder)
+    assert calls() == 0
+    assert snapshot.get('qstat', timeout=5) == '{"Jobs": {}}\n'
+
+
+def test_job_snapshots(monkeypatch, tmp_path):
+    log = tmp_path / "calls"
+    script = tmp_path / "fake_qstat"
+    script.write_text(
+        "#!/bin/sh\n"
+        f"echo \"$@\" >> {log}\n"
+        "echo \"{\\\"Jobs\\\": {\\\"$3\\\": {\\\"job_state\\\": \\\"F\\\"}}}\"\n"
+    )
+    script.chmod(0o755)
+    monkeypatch.setattr(pbs_snapshot, "JOB_SNAPSHOT_COMMAND", str(script) + " -x -f {} -F json")
+    directory = tmp_path / "snap"
+    snapshot = PbsSnapshot(directory=str(directory), ttl=60)
+    assert snapshot.job("12.aqua") == {"job_state": "F"}
+    assert PbsSnapshot(directory=str(directory), ttl=60).job("12.aqua") == {"job_state": "F"}
+    assert snapshot.job("13.aqua[1]") == {"job_state": "F"}
+    assert log.read_text().splitlines() == ["-x -f 12.aqua -F json", "-x -f 13.aqua[1] -F json"]
+    # Job IDs are not passed on if they are not plain.
+    assert snapshot.job("12.aqua; rm -rf x") is None
+
+    # Snapshots of jobs not asked about for a while are deleted.
+    old = time.time() - 2 * pbs_snapshot.JOB_SNAPSHOT_EXPIRY
+    for name in os.listdir(directory):
+        os.utime(directory / name, (old, old))
+    snapshot.job("14.aqua")
+    assert sorted(n for n in os.listdir(directory) if not n.startswith(".")) == ["job.14.aqua.{}".format(os.getuid())]
@@ -1,15 +1,21 @@
 import json
+import shutil
 import subprocess
 from pathlib import Path
 
 
-def test_qstat_filter_outputs_only_requested_user():
-    repo = Path(__file__).resolve().parents[1]
+def build_qstat_filter(repo):
     crate = repo / "qstat_filter"
     bin_path = crate / "target" / "release" / "qstat_filter"
 
     if not bin_path.exists():
         subprocess.run(["cargo", "build", "--release"], cwd=crate, check=True)
+    return bin_path
+
+
+def test_qstat_filter_outputs_only_requested_user():
+    repo = Path(__file__).resolve().parents[1]
+    bin_path = build_qstat_filter(repo)
 
     proc = subprocess.run(
         [
@@ -26,3 +32,82 @@ def test_qstat_filter_outputs_only_requested_user():
     assert lines, "qstat_filter produced no output"
     assert all(job.get("euser") == "root" for job in lines)
     assert all("id" in job for job in lines)
+
+
+def test_qstat_filter_shards_by_user(tmp_path):
+    repo = Path(__file__).resolve().parents[1]
+    bin_path = build_qstat_filter(repo)
+    snapshot = tmp_path / "qstat.json"
+    shutil.copy(repo / "tests" / "data" / "qstat.json", snapshot)
+
+    for _ in range(3):
+        subprocess.run([str(bin_path), "--shard", str(snapshot)], check=True)
+
+    index = json.loads((tmp_path / "qstat.json.shards.json").read_text())
+    assert index["source"]["size"] == snapshot.stat().st_size
+    entry = index["users"]["root"]
+    shard = tmp_path / index["dir"] / entry["file"]
+    jobs = [json.loads(line) for line in shard.read_text().splitlines()]
+    assert len(jobs) == entry["jobs"] == sum(entry["states"].values())
+    assert shard.stat().st_size == entry["bytes"]
+    assert all(job["euser"] == "root" and "id" in job for job in jobs)
+    # Only the current and previous shards are kept.
+    assert len(list((tmp_path / "qstat.json.shards").iterdir())) == 2
+
+
+def test_qstat_filter_compact_matches_parse_job(tmp_path):
+    repo = Path(__file__).resolve().parents[1]
+    import runpy
+    bin_path = build_qstat_filter(repo)
+    mqtop = runpy.run_path(str(repo / "bin" / "mqtop"))
+    jobs = json.loads((repo / "tests" / "data" / "qstat_array.json").read_text())["Jobs"]
+    jobs["600.server"] = {
+        "Job_Name": "odd\tname\\with breaks",
+        "Job_Owner": "root@host",
+        "euser": "root",
+        "job_state": "F",
+        "queue": "cpu_batch_exec",
+        "qtime": "Sun Mar 31 01:30:00 2024",
+        "stime": "Mon Jan  1 10:00:00 2024",
+        "obittime": "Sun Oct 27 01:30:00 2024",
+        "mtime": "Tue Feb 29 23:59:59 2028",
+        "Exit_status": -1,
+        "Resource_List": {"ncpus": "8", "ngpus": 1, "mem": "1536mb", "walltime": "48:00:00"},
+        "resources_used": {"cpupercent": 799, "ncpus": 8, "mem": "12345678b", "vmem": "3gb",
+                           "walltime": "47:59:59", "cput": "383:00:01"},
+    }
+    jobs["601.server"] = {"euser": "root", "Resource_List": {"mem": "2tb"}, "resources_used": {"mem": "5KB"}}
+    snapshot = tmp_path / "qstat.json"
+    snapshot.write_text(json.dumps({"Jobs": jobs}))
+
+    proc = subprocess.run([str(bin_path), "--compact", str(snapshot), "root"],
+                          text=True, capture_output=True, check=True)
+    lines = proc.stdout.split("\n")
+    assert lines[0] == mqtop["COMPACT_HEADER"]
+    rows = [mqtop["_parse_compact_row"](line) for line in lines[1:] if line]
+    expected = []
+    for jid, info in jobs.items():
+        info = dict(info, id=jid)
+        expected.append(mqtop["_parse_job"](info))
+    assert sorted(rows, key=lambda j: j["id"]) == sorted(expected, key=lambda j: j["id"])
+
+
+def test_qstat_filter_matches_python_fallback_on_synthetic_cluster(tmp_path):
+    repo = Path(__file__).resolve().parents[1]
+    import runpy
+    import sys
+    sys.path.insert(0, str(repo))
+    from hpc_scripts.synthetic_qstat import synthetic_snapshot
+
+    bin_path = build_qstat_filter(repo)
+    mqtop = runpy.run_path(str(repo / "bin" / "mqtop"))
+    parse = mqtop["_parse_jobs_from_json"]
+    snapshot = tmp_path / "qstat.json"
+    snapshot.write_text(json.dumps(synthetic_snapshot(1000, 9000, seed=3)))
+
+    parse.__globals__["QSTAT_FILTER"] = str(bin_path)
+    rust = parse(str(snapshot), "me")
+    parse.__globals__["QSTAT_FILTER"] = str(tmp_path / "missing")
+    python = parse(str(snapshot), "me")
+    assert len(python) == 1000
+    assert rust == python
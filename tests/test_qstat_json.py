@@ -0,0 +1,46 @@
+import io
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from hpc_scripts.qstat_json import iter_jobs
+
+DATA = Path(__file__).resolve().parent / "data"
+
+
+@pytest.mark.parametrize("name", ["qstat.json", "qstat_array.json"])
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 20])
+def test_iter_jobs_matches_json_load(name, chunk_size):
+    text = (DATA / name).read_text()
+    jobs = json.loads(text)["Jobs"]
+    assert list(iter_jobs(io.StringIO(text), chunk_size=chunk_size)) == list(jobs.items())
+    assert list(iter_jobs(io.StringIO(text), euser="root", chunk_size=chunk_size)) == [
+        (jid, job) for jid, job in jobs.items() if job.get("euser") == "root"
+    ]
+
+
+@pytest.mark.parametrize("indent", [None, 4])
+@pytest.mark.parametrize("chunk_size", [1, 5, 1000])
+def test_iter_jobs_handles_braces_and_quotes_in_strings(indent, chunk_size):
+    jobs = {
+        "1.s": {"euser": "me", "Variable_List": 'a={b}"c\\"}{', "nested": {"x": {}}},
+        "2.s": {"euser": "mex", "Job_Name": '"me"'},
+        "3.s": {"Job_Name": "me", "euser": "you"},
+        "4[].s": {"euser": "me", "Resource_List": {"ncpus": 1}},
+    }
+    text = json.dumps({"timestamp": 1, "pbs_server": "{s}", "Jobs": jobs}, indent=indent)
+    assert list(iter_jobs(io.StringIO(text), chunk_size=chunk_size)) == list(jobs.items())
+    # Jobs that only mention the user elsewhere are skipped.
+    assert [jid for jid, _ in iter_jobs(io.StringIO(text), euser="me", chunk_size=chunk_size)] == ["1.s", "4[].s"]
+
+
+def test_iter_jobs_rejects_truncated_document():
+    text = json.dumps({"Jobs": {"1.s": {"euser": "me"}, "2.s": {"euser": "me"}}})
+    with pytest.raises(ValueError):
+        list(iter_jobs(io.StringIO(text[:-8]), chunk_size=4))
+    assert list(iter_jobs(io.StringIO('{"Jobs": {}}'))) == []
+    assert list(iter_jobs(io.StringIO('{"timestamp": 1}'))) == []
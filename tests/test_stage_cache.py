@@ -0,0 +1,126 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from hpc_scripts import stage_cache
+from hpc_scripts.parallel_copy import copy_tree
+from hpc_scripts.stage_cache import StageCache
+
+
+def make_source(tmp_path, name="db", size=100):
+    source = tmp_path / name
+    source.mkdir()
+    (source / "sub").mkdir()
+    (source / "sub" / "a").write_bytes(b"x" * size)
+    return source
+
+
+def dead_pid():
+    process = subprocess.Popen(["true"])
+    process.wait()
+    return process.pid
+
+
+def test_jobs_share_one_copy(tmp_path, monkeypatch):
+    monkeypatch.setattr(stage_cache, "POLL_INTERVAL", 0.01)
+    source = make_source(tmp_path)
+    cache = StageCache(str(tmp_path / "cache"), max_bytes=10**6)
+    copies = []
+
+    def slow_copy(src, dest, manifest):
+        copies.append(src)
+        time.sleep(0.2)
+        copy_tree(src, dest, manifest)
+
+    paths = []
+    threads = [threading.Thread(target=lambda ref=ref: paths.append(cache.acquire(str(source), ref, os.getpid(), copy=slow_copy)))
+               for ref in ("1.aqua", "2.aqua", "3.aqua")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(copies) == 1
+    assert len(set(paths)) == 1 and paths[0].endswith("/data/db")
+    assert (Path(paths[0]) / "sub" / "a").read_bytes() == b"x" * 100
+    [entry] = cache.entries()
+    assert entry["complete"] and entry["size"] == 100
+    assert sorted(entry["refs"]) == ["1.aqua", "2.aqua", "3.aqua"]
+
+    cache.release("2.aqua")
+    assert sorted(cache.entries()[0]["refs"]) == ["1.aqua", "3.aqua"]
+
+    # A changed source is copied again.
+    (source / "sub" / "a").write_bytes(b"y" * 100)
+    assert cache.acquire(str(source), "4.aqua", os.getpid()) != paths[0]
+    assert len(cache.entries()) == 2
+
+
+def test_abandoned_copy_and_dead_jobs(tmp_path):
+    source = make_source(tmp_path)
+    cache = StageCache(str(tmp_path / "cache"), max_bytes=10**6)
+    path = cache.acquire(str(source), "1.aqua", dead_pid())
+    # The job holding the reference has gone.
+    assert cache.entries()[0]["refs"] == []
+
+    # A job killed while copying leaves an incomplete entry, which is
+    # copied afresh.
+    key = cache.entries()[0]["key"]
+    os.remove(os.path.join(cache.directory, key, "complete"))
+    with open(os.path.join(cache.directory, key, "copying"), "w") as f:
+        f.write(str(dead_pid()))
+    assert cache.acquire(str(source), "2.aqua", os.getpid()) == path
+    assert cache.entries()[0]["complete"] and cache.entries()[0]["refs"] == ["2.aqua"]
+
+
+def test_least_recently_used_unreferenced_entries_are_evicted(tmp_path, capsys):
+    sources = [make_source(tmp_path, name) for name in ("a", "b", "c")]
+    cache = StageCache(str(tmp_path / "cache"), max_bytes=250)
+    cache.acquire(str(sources[0]), "1.aqua", os.getpid())
+    cache.acquire(str(sources[1]), "2.aqua", os.getpid())
+    cache.release("1.aqua")
+    cache.release("2.aqua")
+    a, b = [e["key"] for e in sorted(cache.entries(), key=lambda e: cache._last_used(e["key"]))]
+    os.utime(os.path.join(cache.directory, a, "refs"), (1, 1))
+
+    cache.acquire(str(sources[2]), "3.aqua", os.getpid())
+    keys = {e["key"] for e in cache.entries()}
+    assert a not in keys and b in keys and len(keys) == 2
+    assert not [name for name in os.listdir(cache.directory) if name.startswith(".evicted")]
+
+    # Entries in use are kept, and a copy with no room is refused.
+    cache.acquire(str(sources[1]), "4.aqua", os.getpid())
+    assert cache.acquire(str(sources[0]), "5.aqua", os.getpid()) is None
+    assert len(cache.entries()) == 2
+    assert "5.aqua" not in sum((e["refs"] for e in cache.entries()), [])
+    assert "No room" in capsys.readouterr().err
+
+
+def test_room_is_left_free_on_the_filesystem(tmp_path, monkeypatch):
+    source = make_source(tmp_path)
+    cache = StageCache(str(tmp_path / "cache"))
+    free = os.statvfs(cache.directory)
+    free_fraction = free.f_bavail / free.f_blocks
+    monkeypatch.setattr(stage_cache, "MIN_FREE_FRACTION", free_fraction + 0.01)
+    assert cache.acquire(str(source), "1.aqua", os.getpid()) is None
+    monkeypatch.setattr(stage_cache, "MIN_FREE_FRACTION", max(free_fraction - 0.01, 0))
+    assert cache.acquire(str(source), "1.aqua", os.getpid()) is not None
+
+
+def test_copies_are_read_only_and_can_be_evicted(tmp_path):
+    source = make_source(tmp_path)
+    cache = StageCache(str(tmp_path / "cache"), max_bytes=10**6)
+    path = cache.acquire(str(source), "1.aqua", os.getpid())
+    for p in (path, os.path.join(path, "sub"), os.path.join(path, "sub", "a")):
+        assert os.stat(p).st_mode & 0o222 == 0
+
+    # Releasing with evict deletes the copies no job uses, but not others.
+    other = cache.acquire(str(make_source(tmp_path, "other")), "2.aqua", os.getpid())
+    cache.release("1.aqua", evict=True)
+    assert not os.path.exists(path) and os.path.exists(other)
+    assert [name for name in os.listdir(cache.directory) if not name.startswith(".lock")] == [cache.entries()[0]["key"]]
@@ -0,0 +1,50 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from hpc_scripts import usage_history
+from hpc_scripts.usage_history import UsageHistory, percentile
+
+
+def test_record_builds_bucket_aggregates(tmp_path):
+    history = UsageHistory(str(tmp_path / "history.sqlite"))
+    start = 1_700_000_000 - 1_700_000_000 % 3600
+    for i, value in enumerate([10, 20, 30, 40, 50, 60]):
+        history.record({'cpu': value}, ts=start + i * 60)
+    # Six samples in one hour, split across two 5-minute buckets.
+    assert history.series('cpu', start, start + 3600, resolution=3600) == [(start, 35.0, 10.0, 60.0)]
+    assert history.series('cpu', start, start + 3600, resolution=300) == [
+        (start, 30.0, 10.0, 50.0),
+        (start + 300, 60.0, 60.0, 60.0),
+    ]
+    assert history.latest('cpu') == (start + 300, 60.0)
+    assert history.metrics() == ['cpu']
+
+
+def test_record_prunes_old_rows(tmp_path):
+    history = UsageHistory(str(tmp_path / "history.sqlite"))
+    old = 1_700_000_000
+    history.record({'cpu': 10}, ts=old)
+    history.record({'cpu': 20}, ts=old + 40 * usage_history.DAY)
+    # Raw samples and 5-minute buckets have expired, hourly buckets have not.
+    assert history.db.execute("SELECT count(*) FROM samples").fetchone()[0] == 1
+    assert len(history.series('cpu', 0, old + 41 * usage_history.DAY, resolution=300)) == 1
+    assert len(history.series('cpu', 0, old + 41 * usage_history.DAY, resolution=3600)) == 2
+
+
+def test_history_survives_reopening(tmp_path):
+    path = str(tmp_path / "history.sqlite")
+    history = UsageHistory(path)
+    history.record({'cpu': 10}, ts=3600)
+    history.close()
+    history = UsageHistory(path)
+    history.record({'cpu': 30}, ts=3660)
+    assert history.series('cpu', 0, 7200) == [(3600, 20.0, 10.0, 30.0)]
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([5], 95) == 5
+    assert percentile([4, 1, 3, 2], 50) == 2.5
+    assert percentile(range(101), 95) == 95